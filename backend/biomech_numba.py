@@ -0,0 +1,107 @@
+"""Numba-compiled pose risk scoring for CPU-only hosts.
+
+Scores every person in a frame in one native loop, with the same factors,
+thresholds and composite as the NumPy path in main.py. Triplets, threshold
+tables and weights are passed in so main.py stays their single source.
+"""
+
+import math
+
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True, fastmath=True)
+def _angle(ax, ay, bx, by, cx, cy):
+    """Angle at B formed by A-B-C, in degrees; 180 for a zero-length limb."""
+    bax, bay = ax - bx, ay - by
+    bcx, bcy = cx - bx, cy - by
+    n1, n2 = math.hypot(bax, bay), math.hypot(bcx, bcy)
+    if n1 == 0.0 or n2 == 0.0:
+        return 180.0
+    cosine = (bax * bcx + bay * bcy) / (n1 * n2)
+    return math.degrees(math.acos(min(max(cosine, -1.0), 1.0)))
+
+
+@njit(cache=True)
+def _mid(a, b):
+    return np.float32(np.float32(a + b) / np.float32(2))
+
+
+@njit(cache=True)
+def _risk(thresholds, levels, j, x):
+    return levels[j, np.searchsorted(thresholds[j], x, side="right")]
+
+
+@njit(cache=True)
+def score_people(kps, confs, conf_thresh, triplets, thresholds, levels, weights,
+                 out_risks, out_details, out_composite):
+    """
+    Score (P,17,2) float32 keypoints with (P,17) float32 confidences.
+
+    Fills out_risks (P,9) in factor order with -1 for factors that are not
+    visible, out_details (P,5) with knee/hip angles and trunk lean (NaN if
+    not visible), and out_composite (P,) with the 0-100 weighted score.
+    Factors 4-8 (trunk, asymmetries, ankles) are binned on the negated value.
+    """
+    vis = np.empty(17, np.bool_)
+    for p in range(kps.shape[0]):
+        for k in range(17):
+            vis[k] = confs[p, k] > conf_thresh and kps[p, k, 0] > 0 and kps[p, k, 1] > 0
+        out_risks[p, :] = -1
+        out_details[p, :] = np.nan
+
+        # Knee ACL and hip flexion
+        for j in range(triplets.shape[0]):
+            a, b, c = triplets[j, 0], triplets[j, 1], triplets[j, 2]
+            if vis[a] and vis[b] and vis[c]:
+                angle = _angle(np.float64(kps[p, a, 0]), np.float64(kps[p, a, 1]),
+                               np.float64(kps[p, b, 0]), np.float64(kps[p, b, 1]),
+                               np.float64(kps[p, c, 0]), np.float64(kps[p, c, 1]))
+                out_details[p, j] = angle
+                out_risks[p, j] = _risk(thresholds, levels, j, angle)
+
+        # Trunk lean from vertical, midpoints in float32 like the NumPy path
+        if vis[5] and vis[6] and vis[11] and vis[12]:
+            dx = np.float64(_mid(kps[p, 11, 0], kps[p, 12, 0]) - _mid(kps[p, 5, 0], kps[p, 6, 0]))
+            dy = np.float64(_mid(kps[p, 11, 1], kps[p, 12, 1]) - _mid(kps[p, 5, 1], kps[p, 6, 1]))
+            lean = 0.0 if dy == 0 else abs(math.degrees(math.atan2(dx, dy)))
+            out_details[p, 4] = lean
+            out_risks[p, 4] = _risk(thresholds, levels, 4, -lean)
+
+        # Shoulder and hip height asymmetry
+        if vis[5] and vis[6]:
+            out_risks[p, 5] = _risk(thresholds, levels, 5, -abs(kps[p, 5, 1] - kps[p, 6, 1]))
+        if vis[11] and vis[12]:
+            out_risks[p, 6] = _risk(thresholds, levels, 6, -abs(kps[p, 11, 1] - kps[p, 12, 1]))
+
+        # Ankles, against a virtual toe projected past each ankle
+        for j, knee, ankle in ((7, 13, 15), (8, 14, 16)):
+            if vis[knee] and vis[ankle]:
+                kx, ky = kps[p, knee, 0], kps[p, knee, 1]
+                ax, ay = kps[p, ankle, 0], kps[p, ankle, 1]
+                tx = ax + (ax - kx) * np.float32(0.3)
+                ty = ay + np.float32(30)
+                angle = _angle(np.float64(kx), np.float64(ky), np.float64(ax), np.float64(ay),
+                               np.float64(tx), np.float64(ty))
+                out_risks[p, j] = _risk(thresholds, levels, j, -angle)
+
+        # Composite weighted score over the visible factors
+        acc, total_weight = 0.0, 0.0
+        for j in range(weights.shape[0]):
+            if out_risks[p, j] >= 0:
+                acc += out_risks[p, j] * weights[j]
+                total_weight += weights[j]
+        out_composite[p] = min(int(acc / total_weight), 100) if total_weight > 0 else 0
+
+
+def _warm_up():
+    """Compile (or load from cache) for the dtypes main.py passes, before the first upload."""
+    n_factors = 9
+    score_people(np.zeros((1, 17, 2), np.float32), np.zeros((1, 17), np.float32), 0.5,
+                 np.zeros((4, 3), np.int64), np.zeros((n_factors, 3)),
+                 np.zeros((n_factors, 4), np.int64), np.zeros(n_factors),
+                 np.empty((1, n_factors), np.int64), np.empty((1, 5)), np.empty(1, np.int64))
+
+
+_warm_up()
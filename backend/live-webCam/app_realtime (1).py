@@ -1,12 +1,21 @@
 import streamlit as st
+import av
 import cv2
 import numpy as np
+import torch
+import functools
 import math
 import time
 import os
 import tempfile
+import json
+import queue
+import threading
 from collections import deque
+from pathlib import Path
+from numba import njit
 from ultralytics import YOLO
+from ultralytics.models.yolo.pose import PosePredictor
 
 st.set_page_config(page_title="Injury Risk Monitor", layout="wide", page_icon="🏃")
 
@@ -31,125 +40,594 @@ with st.sidebar:
     frame_skip   = st.slider("Frame Skip", 1, 5, 1,
                              help="Increase if processing is slow")
     alert_thresh = st.slider("Alert Threshold (%)", 30, 90, 70)
+    use_int8     = st.checkbox("INT8 model on CPU (experimental)", value=False,
+                               help="Quantized with frames from ./calibration and only "
+                                    "used if its joint angles stay close to the FP32 model")
 
     st.markdown("---")
     st.header("📥 Input Source")
     source_type = st.radio("Choose source", ["🎥 Webcam", "📁 Upload Video"])
 
 # ── Model ──────────────────────────────────────────────────────────────────────
+DEVICE = "cuda:0" if torch.cuda.is_available() else "cpu"
+HALF   = DEVICE != "cpu"          # fp16 only pays off on GPU tensor cores
+IMGSZ  = 640
+INFER_W = 640                     # frames are analysed and shown at this width
+BATCH   = 4                       # frames per forward pass for uploaded videos
+HIST_LEN = 60                     # points in the live risk sparkline
+UI_HZ   = 15                      # max Streamlit refresh rate; analysis runs unthrottled
+
+
+CALIB_DIR = "calibration"        # images / clips from real sessions, used to build the INT8 model
+CALIB_FRAMES = 200                # frames sampled from CALIB_DIR; half calibrate, half validate
+INT8_ANGLE_TOL = 5.0              # max p95 joint-angle drift (deg) vs FP32 before INT8 is refused
+
+
+def calibration_frames(limit=CALIB_FRAMES):
+    """BGR frames from CALIB_DIR: every image, plus ~30 evenly spaced frames per video."""
+    frames = []
+    for path in sorted(Path(CALIB_DIR).glob("*")):
+        ext = path.suffix.lower()
+        if ext in (".jpg", ".jpeg", ".png"):
+            img = cv2.imread(str(path))
+            if img is not None:
+                frames.append(img)
+        elif ext in (".mp4", ".avi", ".mov", ".mkv", ".webm"):
+            cap = cv2.VideoCapture(str(path))
+            step = max(1, int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) // 30)
+            i = 0
+            while cap.grab():
+                if i % step == 0:
+                    ok, frame = cap.retrieve()
+                    if ok:
+                        frames.append(frame)
+                i += 1
+            cap.release()
+    return frames[::max(1, len(frames) // limit)][:limit]
+
+
+def main_person(result):
+    """(17,2) keypoints, (17,) confs and box centre of the most confident person, or None."""
+    if result.keypoints is None or not len(result.boxes):
+        return None
+    i = int(result.boxes.conf.argmax())
+    box = result.boxes.xyxy[i].cpu().numpy()
+    return (result.keypoints.xy[i].cpu().numpy(), result.keypoints.conf[i].cpu().numpy(),
+            (box[:2] + box[2:]) / 2)
+
+
+def angle_drift(ref, quant, frames):
+    """95th-percentile |joint angle| difference between two pose models over frames (deg).
+
+    Compares the reference's most confident person with the quantized model's
+    nearest detection; inf when too few joints are visible in both to judge.
+    """
+    diffs = []
+    for frame in frames:
+        r, q = (m.predict(frame, imgsz=IMGSZ, verbose=False)[0] for m in (ref, quant))
+        a = main_person(r)
+        if a is None or q.keypoints is None or not len(q.boxes):
+            continue
+        centres = (q.boxes.xyxy[:, :2] + q.boxes.xyxy[:, 2:]).cpu().numpy() / 2
+        j = int(np.linalg.norm(centres - a[2], axis=1).argmin())
+        b = (q.keypoints.xy[j].cpu().numpy(), q.keypoints.conf[j].cpu().numpy())
+        ang_a = _joint_angles(a[0][None], a[1][None], 0.5)[0]
+        ang_b = _joint_angles(b[0][None], b[1][None], 0.5)[0]
+        seen = (ang_a >= 0) & (ang_b >= 0)
+        diffs.extend(np.abs(ang_a - ang_b)[seen])
+    return float(np.percentile(diffs, 95)) if len(diffs) >= 20 else math.inf
+
+
+def int8_onnx(s):
+    """Build the INT8 ONNX yolov8{s}-pose once and measure its angle drift; cached on disk.
+
+    Returns (path, p95 angle drift in degrees), or None when CALIB_DIR has too
+    few frames. Delete the cached .onnx/.json to rebuild after changing CALIB_DIR.
+    Raises ImportError without onnx / onnxruntime.
+    """
+    # Only needed for the opt-in INT8 model, so the app runs without them
+    import onnx
+    from onnxruntime.quantization import (CalibrationDataReader, QuantFormat, QuantType,
+                                          quantize_static)
+
+    q_path, check_path = f"yolov8{s}-pose-int8.onnx", f"yolov8{s}-pose-int8.json"
+    if os.path.exists(q_path) and os.path.exists(check_path):
+        with open(check_path) as f:
+            return q_path, json.load(f)["p95_angle_drift"]
+    frames = calibration_frames()
+    if len(frames) < 20:
+        return None
+
+    class CalibrationFrames(CalibrationDataReader):
+        """Feeds letterboxed BGR frames to ONNX Runtime's static quantizer."""
+
+        def __init__(self, frames):
+            self.frames = iter(frames)
+
+        def get_next(self):
+            img = next(self.frames, None)
+            if img is None:
+                return None
+            h, w = img.shape[:2]
+            r = IMGSZ / max(h, w)
+            canvas = np.full((IMGSZ, IMGSZ, 3), 114, np.uint8)
+            canvas[:round(h * r), :round(w * r)] = cv2.resize(img, (round(w * r), round(h * r)))
+            blob = canvas[..., ::-1].transpose(2, 0, 1)[None].astype(np.float32) / 255
+            return {"images": blob}
+
+    ref = YOLO(f"yolov8{s}-pose.pt")
+    fp32 = ref.export(format="onnx", imgsz=IMGSZ, dynamic=True, simplify=True)
+    # Backbone and neck convs only: the whole pose head (box and keypoint
+    # regression) stays FP32, since joint angles are scored in 10-20° bands
+    head = f"/model.{len(ref.model.model) - 1}/"
+    exclude = [n.name for n in onnx.load(fp32).graph.node if n.name.startswith(head)]
+    quantize_static(fp32, q_path, CalibrationFrames(frames[::2]),
+                    quant_format=QuantFormat.QDQ, op_types_to_quantize=["Conv"],
+                    nodes_to_exclude=exclude, per_channel=True,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+
+    drift = angle_drift(ref, YOLO(q_path, task="pose"), frames[1::2])
+    with open(check_path, "w") as f:
+        json.dump({"p95_angle_drift": drift, "validation_frames": len(frames[1::2])}, f)
+    return q_path, drift
+
+
 @st.cache_resource
-def load_model(s):
-    return YOLO(f"yolov8{s}-pose.pt")
+def load_model(s, int8):
+    """(model, note): the INT8 ONNX model only when asked for on CPU and it passed its check."""
+    note = None
+    if DEVICE == "cpu" and int8:
+        try:
+            built = int8_onnx(s)
+        except ImportError:
+            note = "INT8 needs onnx and onnxruntime installed; using FP32"
+        else:
+            if built is None:
+                note = f"INT8 needs at least 20 sample frames in ./{CALIB_DIR}; using FP32"
+            elif built[1] > INT8_ANGLE_TOL:
+                note = f"INT8 joint angles drift {built[1]:.1f}° (p95) from FP32; using FP32"
+            else:
+                # CPU boxes run the INT8 ONNX graph through ONNX Runtime
+                return YOLO(built[0], task="pose"), f"INT8 model, p95 angle drift {built[1]:.1f}°"
+    m = YOLO(f"yolov8{s}-pose.pt")
+    # Pin weights to the GPU once; predict(half=True) casts them to fp16
+    # when the predictor is first built and reuses it on every frame
+    m.to(DEVICE)
+    return m, note
 
-model = load_model(model_size)
 
 # ── Helpers ────────────────────────────────────────────────────────────────────
-def calculate_angle(a, b, c):
-    a, b, c = np.array(a, float), np.array(b, float), np.array(c, float)
-    ba, bc = a - b, c - b
-    n1, n2 = np.linalg.norm(ba), np.linalg.norm(bc)
-    if n1 == 0 or n2 == 0:
+# Joint triplets (A, B, C), angle measured at B:
+# L/R knee (hip-knee-ankle), L/R hip (shoulder-hip-knee)
+TRIPLETS  = np.array([[11, 13, 15], [12, 14, 16], [5, 11, 13], [6, 12, 14]])
+RISK_KEYS = ("L_ACL", "R_ACL", "L_Hip", "R_Hip", "Trunk")
+RISK_LABELS = ("L Knee (ACL)", "R Knee (ACL)", "L Hip Flex", "R Hip Flex", "Trunk Lean")
+
+# Risk lookup table, one row per RISK_KEYS entry:
+#   level = RISK_VALS[row, number of RISK_BINS[row] <= RISK_SIGN[row] * angle]
+# Trunk scores on `lean >` so its bins are negated to share the `angle <` rule.
+RISK_BINS = np.array([[120, 140, 160], [120, 140, 160],
+                      [100, 130, 150], [100, 130, 150],
+                      [-35, -25, -15]], np.float32)
+RISK_VALS = np.array([[90, 60, 30, 0], [90, 60, 30, 0],
+                      [80, 45, 20, 0], [80, 45, 20, 0],
+                      [75, 50, 25, 0]], np.float32)
+RISK_SIGN = np.array([1, 1, 1, 1, -1], np.float32)
+RISK_WEIGHTS = np.array([0.25, 0.25, 0.10, 0.10, 0.12])
+# Rows shifted 1000° apart so the whole table is one sorted array
+_ROW_OFF   = np.arange(5, dtype=np.float32) * 1000
+_FLAT_BINS = (RISK_BINS + _ROW_OFF[:, None]).ravel()
+_ROW_BASE  = np.arange(5) * RISK_BINS.shape[1]
+
+
+@njit(cache=True, fastmath=True)
+def _angle(ax, ay, bx, by, cx, cy):
+    """Angle at B formed by A-B-C (deg); degenerate limbs count as 180°."""
+    bax, bay = ax - bx, ay - by
+    bcx, bcy = cx - bx, cy - by
+    n = math.sqrt(bax * bax + bay * bay) * math.sqrt(bcx * bcx + bcy * bcy)
+    if n == 0:
         return 180.0
-    return float(np.degrees(np.arccos(np.clip(np.dot(ba, bc) / (n1 * n2), -1, 1))))
+    return math.degrees(math.acos(min(max((bax * bcx + bay * bcy) / n, -1.0), 1.0)))
+
+
+@njit(cache=True, fastmath=True)
+def _person_angles(kp, cf, conf_thresh, out):
+    """Fill out[0:5] with one person's angles in RISK_KEYS order, -1 = not visible."""
+    vis = np.empty(17, np.bool_)
+    for i in range(17):
+        vis[i] = cf[i] > conf_thresh and kp[i, 0] > 0 and kp[i, 1] > 0
+    out[:] = -1.0
+
+    for j in range(4):
+        a, b, c = TRIPLETS[j, 0], TRIPLETS[j, 1], TRIPLETS[j, 2]
+        if vis[a] and vis[b] and vis[c]:
+            out[j] = _angle(kp[a, 0], kp[a, 1], kp[b, 0], kp[b, 1], kp[c, 0], kp[c, 1])
+
+    if vis[5] and vis[6] and vis[11] and vis[12]:
+        dx = (kp[11, 0] + kp[12, 0]) / 2 - (kp[5, 0] + kp[6, 0]) / 2
+        dy = (kp[11, 1] + kp[12, 1]) / 2 - (kp[5, 1] + kp[6, 1]) / 2
+        out[4] = abs(math.degrees(math.atan2(dx, dy))) if dy != 0 else 0.0
+
+
+@njit(cache=True, fastmath=True)
+def _joint_angles(kpts, confs, conf_thresh):
+    """(P,17,2) keypoints + (P,17) confs → (P,5) angles in RISK_KEYS order, -1 = not visible."""
+    out = np.empty((kpts.shape[0], 5), np.float32)
+    for p in range(kpts.shape[0]):
+        _person_angles(kpts[p], confs[p], conf_thresh, out[p])
+    return out
+
+
+@njit(cache=True)
+def _single_person_compute(kp, cf, conf_thresh):
+    """One person end to end in native code: (17,2), (17,) → (composite, (5,) risks)."""
+    risks = np.empty(5, np.float32)
+    _person_angles(kp, cf, conf_thresh, risks)
+    acc, tw = 0.0, 0.0
+    for j in range(5):
+        if risks[j] < 0:
+            continue
+        x, k = risks[j] * RISK_SIGN[j], 0
+        while k < RISK_BINS.shape[1] and RISK_BINS[j, k] <= x:
+            k += 1
+        risks[j] = RISK_VALS[j, k]
+        acc += risks[j] * RISK_WEIGHTS[j]
+        tw  += RISK_WEIGHTS[j]
+    return (min(int(acc / tw), 100) if tw > 0 else 0), risks
+
+
+def score_angles(angles):
+    """(P,5) angles → (P,5) risk levels with one searchsorted over the fused table."""
+    idx = np.searchsorted(_FLAT_BINS, angles * RISK_SIGN + _ROW_OFF, side="right") - _ROW_BASE
+    lvl = np.take_along_axis(RISK_VALS[None], idx[..., None], axis=-1)[..., 0]
+    return np.where(angles < 0, -1.0, lvl)
+
+
+# Compile (or load from cache) before the first frame arrives
+_joint_angles(np.zeros((1, 17, 2), np.float32), np.zeros((1, 17), np.float32), 0.5)
+_single_person_compute(np.zeros((17, 2), np.float32), np.zeros(17, np.float32), 0.5)
+NO_RISKS = np.full(5, -1.0, np.float32)
+
+model, model_note = load_model(model_size, use_int8)
+if model_note:
+    st.sidebar.caption(model_note)
+
+
+# Score (0-100) → label / colour, tabulated once so lookups are a single index
+_LABELS = tuple("LOW" if s < 30 else "MODERATE" if s < 60 else "HIGH" if s < 80 else "CRITICAL"
+                for s in range(101))
+_HEX    = tuple("#27ae60" if s < 30 else "#f39c12" if s < 60 else "#e67e22" if s < 80 else "#e74c3c"
+                for s in range(101))
+_BGR    = tuple((0, 200, 0) if s < 30 else (0, 200, 255) if s < 60 else (0, 100, 255) if s < 80 else (0, 0, 230)
+                for s in range(101))
 
 def risk_label(s):
-    return "LOW" if s < 30 else "MODERATE" if s < 60 else "HIGH" if s < 80 else "CRITICAL"
+    return _LABELS[min(max(s, 0), 100)]
 
 def risk_hex(s):
-    return "#27ae60" if s < 30 else "#f39c12" if s < 60 else "#e67e22" if s < 80 else "#e74c3c"
+    return _HEX[min(max(s, 0), 100)]
 
 def risk_bgr(s):
-    return (0, 200, 0) if s < 30 else (0, 200, 255) if s < 60 else (0, 100, 255) if s < 80 else (0, 0, 230)
+    return _BGR[min(max(s, 0), 100)]
+
+
+STRIP_H = 60
+_alert_strip = np.empty((STRIP_H, 0, 3), np.uint8)
+
+
+def alert_strip(w):
+    """Solid red alert banner, reallocated only when the frame width changes."""
+    global _alert_strip
+    if _alert_strip.shape[1] != w:
+        _alert_strip = np.full((STRIP_H, w, 3), (0, 0, 160), np.uint8)
+    return _alert_strip
+
+
+class PinnedPosePredictor(PosePredictor):
+    """PosePredictor that stages letterboxed frames in one reused pinned host buffer.
+
+    Page-locked memory lets the host→device copy run as a direct DMA instead of
+    bouncing through a pageable staging area on every frame.
+    """
+
+    host = None
+
+    def preprocess(self, im):
+        if isinstance(im, torch.Tensor) or self.device.type != "cuda":
+            return super().preprocess(im)
+        im = self.pre_transform(im)
+        shape = (len(im), *im[0].shape)
+        if self.host is None or tuple(self.host.shape) != shape:
+            self.host = torch.empty(shape, dtype=torch.uint8, pin_memory=True)
+        # Safe to overwrite: the previous batch's copy finished before its
+        # results were pulled back to the CPU
+        np.stack(im, out=self.host.numpy())
+        dev = self.host.to(self.device, non_blocking=True)
+        dev = dev.permute(0, 3, 1, 2).flip(1).contiguous()  # BHWC BGR → BCHW RGB
+        return (dev.half() if self.model.fp16 else dev.float()).div_(255)
+
+
+def analyze_batch(frames):
+    """Run YOLOv8 + biomechanics on a list of frames in one forward pass."""
+    results = model.predict(frames, verbose=False, conf=conf_thresh,
+                            device=DEVICE, half=HALF, imgsz=IMGSZ,
+                            predictor=PinnedPosePredictor)
+    return [score_result(f, r) for f, r in zip(frames, results)]
+
+
+def draw_risk(annotated, comp):
+    """Risk caption, plus border and banner once comp crosses the alert threshold."""
+    cv2.putText(annotated, f"Risk: {comp}% [{risk_label(comp)}]",
+                (15, 42), cv2.FONT_HERSHEY_DUPLEX, 1.0, risk_bgr(comp), 2)
+
+    # Alert border
+    if comp >= alert_thresh:
+        fh, fw = annotated.shape[:2]
+        cv2.rectangle(annotated, (0, 0), (fw - 1, fh - 1), (0, 0, 255), 8)
+        # Blend the banner into its strip only, not the whole frame
+        y0 = fh // 2 - STRIP_H // 2
+        roi = annotated[y0:y0 + STRIP_H]
+        cv2.addWeighted(alert_strip(fw), 0.65, roi, 0.35, 0, dst=roi)
+        cv2.putText(annotated, f"  ⚠ ALERT: {comp}% — {risk_label(comp)}  ",
+                    (fw // 2 - 240, fh // 2 + 12),
+                    cv2.FONT_HERSHEY_DUPLEX, 0.9, (255, 255, 255), 2)
+
+
+def score_result(frame, r):
+    """Biomechanics + overlay for one frame's YOLO result.
+
+    Returns (annotated, risk, risks) where risks is the riskiest person's
+    5-vector in RISK_KEYS order (-1 = not visible).
+    """
+    if r.keypoints is None or len(r.keypoints) == 0:
+        return frame, 0, NO_RISKS
+
+    # One host copy of boxes and keypoints, scored first and then drawn by
+    # plot() without further device reads
+    r = r.cpu()
+    kpts  = r.keypoints.xy.numpy().astype(np.float32)
+    confs = r.keypoints.conf.numpy().astype(np.float32)
+
+    if len(kpts) == 1:
+        # Usual webcam case: one native call, no per-person dicts
+        comp, risks = _single_person_compute(kpts[0], confs[0], float(conf_thresh))
+        # plot() allocates its own canvas — no need to copy the frame first
+        annotated = r.plot(kpt_radius=4, line_width=2)
+        draw_risk(annotated, comp)
+        return annotated, comp, risks
+
+    risk_rows = score_angles(_joint_angles(kpts, confs, float(conf_thresh)))
+    annotated = r.plot(kpt_radius=4, line_width=2)
+
+    # Weighted mean over visible factors for every person at once
+    rows = np.asarray(risk_rows, np.float64)
+    w    = np.where(rows >= 0, RISK_WEIGHTS, 0.0)
+    tw   = w.sum(axis=1)
+    acc  = (rows * w).sum(axis=1)
+
+    max_risk, max_risks = 0, NO_RISKS
+    for i, row in enumerate(risk_rows):
+        comp = min(int(acc[i] / tw[i]), 100) if tw[i] > 0 else 0
+
+        draw_risk(annotated, comp)
+
+        if comp > max_risk:
+            max_risk, max_risks = comp, row
 
+    return annotated, max_risk, max_risks
 
-def analyze(frame):
-    """Run YOLOv8 + biomechanics on a single frame."""
-    results  = model(frame, verbose=False, conf=conf_thresh)
-    annotated = frame.copy()
-    max_risk, max_risks = 0, {}
 
-    for r in results:
-        if r.keypoints is None:
+def drain_to_latest(cap, skip=1, fresh_s=0.004, max_drain=10):
+    """Grab past stale frames in the driver buffer and decode only the newest.
+
+    Buffered frames come back from grab() almost instantly; once a grab has to
+    wait on the sensor we are at the live edge. Returns (ret, frame, dropped).
+    """
+    for _ in range(skip - 1):
+        cap.grab()
+    dropped = 0
+    t0 = time.perf_counter()
+    if not cap.grab():
+        return False, None, dropped
+    while time.perf_counter() - t0 < fresh_s and dropped < max_drain:
+        t0 = time.perf_counter()
+        if not cap.grab():
+            break
+        dropped += 1
+    ret, frame = cap.retrieve()
+    return ret, frame, dropped
+
+
+def to_infer_size(frame):
+    """Downscale once to INFER_W so YOLO's letterbox and plot() touch fewer pixels."""
+    h, w = frame.shape[:2]
+    if w <= INFER_W:
+        return frame
+    return cv2.resize(frame, (INFER_W, int(h * INFER_W / w)), interpolation=cv2.INTER_LINEAR)
+
+
+def webcam_frames(cap):
+    """Yield (frame_no, frame, stale_dropped) from a live camera."""
+    fc = 0
+    while cap.isOpened():
+        ret, frame, n_drop = drain_to_latest(cap, frame_skip)
+        if not ret:
+            return
+        fc += frame_skip + n_drop
+        yield fc, to_infer_size(frame), n_drop
+
+
+def open_video(path):
+    """Open a file with PyAV, on the GPU decoder when there is one.
+
+    Falls back to multi-threaded software decode when there is no CUDA device,
+    PyAV cannot create the hardware device, or PyAV is older than 14 (no
+    av.codec.hwaccel).
+    """
+    container = None
+    if DEVICE != "cpu":
+        try:
+            from av.codec.hwaccel import HWAccel
+            container = av.open(path, hwaccel=HWAccel(device_type="cuda",
+                                                      allow_software_fallback=True))
+        except (ImportError, av.FFmpegError, OSError):
+            pass
+    if container is None:
+        container = av.open(path)
+    container.streams.video[0].thread_type = "AUTO"
+    return container
+
+
+def video_frames(path):
+    """Yield (frame_no, frame, 0) for every frame_skip-th frame of a file."""
+    with open_video(path) as container:
+        fc = 0
+        for frame in container.decode(video=0):
+            fc += 1
+            if fc % frame_skip == 0:
+                # Only frames we analyse are converted to BGR
+                yield fc, to_infer_size(frame.to_ndarray(format="bgr24")), 0
+
+
+def put_latest(q, item):
+    """Put into a bounded queue, evicting the oldest item when it is full."""
+    try:
+        q.put_nowait(item)
+    except queue.Full:
+        try:
+            q.get_nowait()
+        except queue.Empty:
+            pass
+        q.put_nowait(item)
+
+
+def start_pipeline(frames, live, batch=1):
+    """Run capture and inference on their own threads.
+
+    capture → q_in → analyze_batch → q_out; the Streamlit loop only renders what
+    comes out of q_out. The end marker is None, or the exception that stopped
+    either thread so pipeline_results can re-raise it. Live sources keep just the newest
+    item in each queue; files block instead so no frame is skipped, and are
+    pushed through YOLO `batch` frames at a time, in order.
+    Returns (q_out, stop_event, threads).
+    """
+    stop = threading.Event()
+    q_in, q_out = queue.Queue(maxsize=batch), queue.Queue(maxsize=batch)
+    errors = []
+
+    def send(q, item):
+        if live:
+            put_latest(q, item)
+            return
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def capture():
+        try:
+            for item in frames:
+                if stop.is_set():
+                    break
+                send(q_in, item)
+        except Exception as e:  # e.g. a corrupt upload; frames already sent still get scored
+            errors.append(e)
+        finally:
+            send(q_in, None)
+
+    def flush(pending):
+        outs = analyze_batch([frame for _, frame, _ in pending])
+        for (fc, _, dropped), out in zip(pending, outs):
+            send(q_out, (fc, *out, dropped))
+        pending.clear()
+
+    def infer():
+        pending = deque()
+        try:
+            while not stop.is_set():
+                try:
+                    item = q_in.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    break
+                pending.append(item)
+                if len(pending) >= batch:
+                    flush(pending)
+            if pending and not stop.is_set():
+                flush(pending)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            send(q_out, errors[0] if errors else None)
+
+    threads = [threading.Thread(target=capture, daemon=True),
+               threading.Thread(target=infer, daemon=True)]
+    for t in threads:
+        t.start()
+    return q_out, stop, threads
+
+
+def pipeline_results(q_out, stop):
+    """Yield pipeline outputs on the Streamlit thread until the end marker.
+
+    Re-raises an exception from the capture or inference thread here, so it
+    is shown on the page instead of leaving it waiting.
+    """
+    while not stop.is_set():
+        try:
+            item = q_out.get(timeout=0.5)
+        except queue.Empty:
             continue
-        annotated = r.plot(img=annotated, kpt_radius=4, line_width=2)
-        kpts  = r.keypoints.xy.cpu().numpy()
-        confs = r.keypoints.conf.cpu().numpy()
-
-        for pkp, pconf in zip(kpts, confs):
-            def kp(i):
-                return pkp[i] if (pconf[i] > conf_thresh
-                                  and pkp[i][0] > 0 and pkp[i][1] > 0) else None
-
-            ls, rs = kp(5), kp(6)
-            lh, rh = kp(11), kp(12)
-            lk, rk = kp(13), kp(14)
-            la, ra = kp(15), kp(16)
-            risks  = {}
-
-            if all(v is not None for v in [lh, lk, la]):
-                a = calculate_angle(lh, lk, la)
-                risks["L_ACL"] = 90 if a < 120 else 60 if a < 140 else 30 if a < 160 else 0
-            if all(v is not None for v in [rh, rk, ra]):
-                a = calculate_angle(rh, rk, ra)
-                risks["R_ACL"] = 90 if a < 120 else 60 if a < 140 else 30 if a < 160 else 0
-            if all(v is not None for v in [ls, lh, lk]):
-                a = calculate_angle(ls, lh, lk)
-                risks["L_Hip"] = 80 if a < 100 else 45 if a < 130 else 20 if a < 150 else 0
-            if all(v is not None for v in [rs, rh, rk]):
-                a = calculate_angle(rs, rh, rk)
-                risks["R_Hip"] = 80 if a < 100 else 45 if a < 130 else 20 if a < 150 else 0
-            if all(v is not None for v in [ls, rs, lh, rh]):
-                sm = ((ls[0] + rs[0]) / 2, (ls[1] + rs[1]) / 2)
-                hm = ((lh[0] + rh[0]) / 2, (lh[1] + rh[1]) / 2)
-                dx, dy = hm[0] - sm[0], hm[1] - sm[1]
-                lean = abs(math.degrees(math.atan2(dx, dy))) if dy != 0 else 0
-                risks["Trunk"] = 75 if lean > 35 else 50 if lean > 25 else 25 if lean > 15 else 0
-
-            weights = {"L_ACL": 0.25, "R_ACL": 0.25, "L_Hip": 0.10,
-                       "R_Hip": 0.10, "Trunk": 0.12}
-            tw   = sum(weights[k] for k in risks if k in weights)
-            comp = int(sum(risks[k] * weights[k] for k in risks if k in weights) / tw) if tw > 0 else 0
-            comp = min(comp, 100)
-
-            # Draw risk on frame
-            cv2.putText(annotated, f"Risk: {comp}% [{risk_label(comp)}]",
-                        (15, 42), cv2.FONT_HERSHEY_DUPLEX, 1.0, risk_bgr(comp), 2)
-
-            # Alert border
-            if comp >= alert_thresh:
-                fh, fw = annotated.shape[:2]
-                cv2.rectangle(annotated, (0, 0), (fw - 1, fh - 1), (0, 0, 255), 8)
-                ov = annotated.copy()
-                cv2.rectangle(ov, (0, fh // 2 - 30), (fw, fh // 2 + 30), (0, 0, 160), -1)
-                cv2.addWeighted(ov, 0.65, annotated, 0.35, 0, annotated)
-                cv2.putText(annotated, f"  ⚠ ALERT: {comp}% — {risk_label(comp)}  ",
-                            (fw // 2 - 240, fh // 2 + 12),
-                            cv2.FONT_HERSHEY_DUPLEX, 0.9, (255, 255, 255), 2)
-
-            if comp > max_risk:
-                max_risk, max_risks = comp, risks
+        if item is None:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
 
-    return annotated, max_risk, max_risks
 
+def stop_pipeline(stop, threads):
+    stop.set()
+    for t in threads:
+        t.join(timeout=2)
 
-def render_score_card(comp, all_scores, frame_num=None):
+
+def encode_jpeg(img, quality=75):
+    """BGR frame → JPEG bytes for st.image; a fraction of the raw RGB payload."""
+    return cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+def history_view(hist, n):
+    """Oldest-first view of the sparkline ring buffer after n writes."""
+    return hist[:n] if n < len(hist) else np.roll(hist, -(n % len(hist)))
+
+
+@functools.lru_cache(maxsize=256)
+def _score_card_html(comp, avg, peak):
     c = risk_hex(comp)
-    extra = f"Frame {frame_num} | " if frame_num else ""
     return f"""
     <div style="background:#1a1a2e;border-radius:12px;padding:20px;text-align:center;margin-bottom:10px;">
         <div style="font-size:56px;font-weight:bold;color:{c};line-height:1.1;">{comp}%</div>
         <div style="font-size:20px;color:{c};margin:4px 0;">{risk_label(comp)}</div>
-        <div style="color:#666;font-size:12px;">{extra}Avg: {np.mean(all_scores):.1f}% | Peak: {max(all_scores)}%</div>
+        <div style="color:#666;font-size:12px;">Avg: {avg:.1f}% | Peak: {peak}%</div>
     </div>"""
 
 
-def render_breakdown(risks):
-    labels = {"L_ACL": "L Knee (ACL)", "R_ACL": "R Knee (ACL)",
-              "L_Hip": "L Hip Flex",   "R_Hip": "R Hip Flex", "Trunk": "Trunk Lean"}
+def render_score_card(comp, avg, peak):
+    # Avg is shown to 0.1%, so rounding it first loses nothing and lets the
+    # card repeat while the session average creeps
+    return _score_card_html(int(comp), round(avg, 1), int(peak))
+
+
+@functools.lru_cache(maxsize=256)
+def _breakdown_html(risks):
     md = "<div style='background:#1a1a2e;border-radius:10px;padding:14px;'>"
     md += "<p style='color:#aaa;margin:0 0 10px;font-size:13px;'>📐 Joint Breakdown</p>"
-    for k, lb in labels.items():
-        v  = risks.get(k, 0)
+    for lb, v in zip(RISK_LABELS, risks):
+        v  = max(v, 0)
         c2 = risk_hex(v)
         md += f"<div style='margin:6px 0;'>"
         md += f"<div style='display:flex;justify-content:space-between;'>"
@@ -161,6 +639,20 @@ def render_breakdown(risks):
     return md
 
 
+def render_breakdown(risk_vec):
+    # Risks move in coarse bins, so most frames hit the cache
+    return _breakdown_html(tuple(int(v) for v in risk_vec))
+
+
+_shown_html = {}
+
+def show_html(ph, html):
+    """Push html to a placeholder only when it differs from what it already shows."""
+    if _shown_html.get(id(ph)) != html:
+        _shown_html[id(ph)] = html
+        ph.markdown(html, unsafe_allow_html=True)
+
+
 # ── Layout ─────────────────────────────────────────────────────────────────────
 col1, col2 = st.columns([3, 1])
 
@@ -192,51 +684,62 @@ if source_type == "🎥 Webcam":
         cap = cv2.VideoCapture(int(cam_index))
         cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
         cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
 
         if not cap.isOpened():
             st.error(f"❌ Cannot open camera {cam_index}. Try a different camera index.")
         else:
             all_scores = []
+            score_sum, peak = 0, 0
             fc = 0
             fps_times = deque(maxlen=30)
+            dropped, drop_t0 = 0, time.time()
+            last_ui_t = 0.0
+            hist = np.zeros(HIST_LEN, np.int16)
             status_ph.info("🟢 Webcam running — click **Stop** to end session")
 
-            while cap.isOpened():
-                ret, frame = cap.read()
-                if not ret:
+            q_out, stop, threads = start_pipeline(webcam_frames(cap), live=True)
+            try:
+                for fc, annotated, comp, risks, n_drop in pipeline_results(q_out, stop):
+                    dropped += n_drop
+                    if time.time() - drop_t0 >= 1.0:
+                        status_ph.info(f"🟢 Webcam running — click **Stop** to end session | "
+                                       f"Dropped stale frames: {dropped / (time.time() - drop_t0):.1f}/s")
+                        dropped, drop_t0 = 0, time.time()
+
+                    fps_times.append(time.time())
+                    live_fps = (len(fps_times) / (fps_times[-1] - fps_times[0] + 1e-6)
+                                if len(fps_times) > 1 else 0)
+
+                    hist[len(all_scores) % HIST_LEN] = comp
+                    all_scores.append(comp)
+                    score_sum += comp
+                    peak = max(peak, comp)
+
+                    # Show in Streamlit — at most UI_HZ times a second
+                    if time.time() - last_ui_t >= 1 / UI_HZ:
+                        last_ui_t = time.time()
+                        frame_ph.image(encode_jpeg(annotated), use_column_width=True,
+                                       caption=f"Frame {fc} | FPS: {live_fps:.1f}")
+
+                        show_html(score_ph, render_score_card(comp, score_sum / len(all_scores), peak))
+                        show_html(detail_ph, render_breakdown(risks))
+
+                        # Mini history chart in sidebar
+                        if len(all_scores) > 1:
+                            history_ph.line_chart(
+                                {"Risk %": history_view(hist, len(all_scores))},
+                                height=120
+                            )
+
+                    # Stop button check
+                    if stop_btn:
+                        break
+                else:
                     st.warning("⚠️ Lost webcam feed")
-                    break
-
-                fc += 1
-                if fc % frame_skip != 0:
-                    continue
-
-                fps_times.append(time.time())
-                live_fps = (len(fps_times) / (fps_times[-1] - fps_times[0] + 1e-6)
-                            if len(fps_times) > 1 else 0)
-
-                annotated, comp, risks = analyze(frame)
-                all_scores.append(comp)
-
-                # Show in Streamlit
-                rgb = cv2.cvtColor(annotated, cv2.COLOR_BGR2RGB)
-                frame_ph.image(rgb, channels="RGB", use_column_width=True,
-                               caption=f"Frame {fc} | FPS: {live_fps:.1f}")
-
-                score_ph.markdown(render_score_card(comp, all_scores, fc),
-                                  unsafe_allow_html=True)
-                detail_ph.markdown(render_breakdown(risks), unsafe_allow_html=True)
-
-                # Mini history chart in sidebar
-                if len(all_scores) > 1:
-                    history_ph.line_chart(
-                        {"Risk %": all_scores[-60:]},
-                        height=120
-                    )
-
-                # Stop button check
-                if stop_btn:
-                    break
+            finally:
+                # Also runs when Stop triggers a rerun and interrupts the loop
+                stop_pipeline(stop, threads)
 
             cap.release()
             status_ph.success(f"✅ Session ended — {fc} frames | "
@@ -257,8 +760,15 @@ elif source_type == "📁 Upload Video":
         tfile.write(uploaded.read())
         tfile.close()
 
-        cap = cv2.VideoCapture(tfile.name)
-        total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        with av.open(tfile.name) as container:
+            stream = container.streams.video[0]
+            total = stream.frames
+            # Matroska/WebM headers carry no frame count: estimate from duration
+            if not total and stream.average_rate:
+                if stream.duration:
+                    total = int(stream.duration * stream.time_base * stream.average_rate)
+                elif container.duration:
+                    total = int(container.duration / av.time_base * stream.average_rate)
 
         with col1:
             frame_ph  = st.empty()
@@ -266,35 +776,49 @@ elif source_type == "📁 Upload Video":
             status_ph = st.empty()
 
         all_scores = []
+        score_sum, peak = 0, 0
         fc = 0
+        last_ui_t = 0.0
+        hist = np.zeros(HIST_LEN, np.int16)
 
         status_ph.info(f"⏳ Processing {total} frames...")
 
-        while cap.isOpened():
-            ret, frame = cap.read()
-            if not ret:
-                break
-            fc += 1
-            if fc % frame_skip != 0:
-                continue
-
-            annotated, comp, risks = analyze(frame)
-            all_scores.append(comp)
-
-            rgb = cv2.cvtColor(annotated, cv2.COLOR_BGR2RGB)
-            frame_ph.image(rgb, channels="RGB", use_column_width=True,
+        def show_upload_frame(fc, annotated, comp, risks):
+            frame_ph.image(encode_jpeg(annotated), use_column_width=True,
                            caption=f"Frame {fc}/{total}")
 
             prog_bar.progress(min(fc / max(total, 1), 1.0))
 
-            score_ph.markdown(render_score_card(comp, all_scores, fc),
-                              unsafe_allow_html=True)
-            detail_ph.markdown(render_breakdown(risks), unsafe_allow_html=True)
+            show_html(score_ph, render_score_card(comp, score_sum / len(all_scores), peak))
+            show_html(detail_ph, render_breakdown(risks))
 
             if len(all_scores) > 1:
-                history_ph.line_chart({"Risk %": all_scores[-60:]}, height=120)
+                history_ph.line_chart({"Risk %": history_view(hist, len(all_scores))},
+                                      height=120)
+
+        unshown = None  # latest frame skipped by the UI throttle
+        q_out, stop, threads = start_pipeline(video_frames(tfile.name), live=False, batch=BATCH)
+        try:
+            for fc, annotated, comp, risks, _ in pipeline_results(q_out, stop):
+                hist[len(all_scores) % HIST_LEN] = comp
+                all_scores.append(comp)
+                score_sum += comp
+                peak = max(peak, comp)
+
+                if time.time() - last_ui_t < 1 / UI_HZ:
+                    unshown = (fc, annotated, comp, risks)
+                    continue
+                last_ui_t = time.time()
+                unshown = None
+
+                show_upload_frame(fc, annotated, comp, risks)
+        finally:
+            stop_pipeline(stop, threads)
+
+        # The final frame usually lands inside the throttle window; show it anyway
+        if unshown:
+            show_upload_frame(*unshown)
 
-        cap.release()
         os.unlink(tfile.name)
         prog_bar.progress(1.0)
         status_ph.success(
@@ -1,20 +1,29 @@
-from fastapi import FastAPI, UploadFile, File, BackgroundTasks, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, UploadFile, File, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
 from pydantic import BaseModel
 from typing import Optional
+import asyncio
 import uuid
 import os
 import shutil
+import subprocess
 import math
 import cv2
 import numpy as np
 import base64
 import json
+import itertools
+import queue
+import threading
 import time
+import torch
 from ultralytics import YOLO
+from biomech_numba import score_people as score_people_native
+from cachetools import LRUCache
 from collections import deque
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 import google.generativeai as genai
 
@@ -32,7 +41,19 @@ else:
 
 # ── App Setup ────────────────────────────────────────────────────
 
-app = FastAPI(title="PoseGuard AI", version="2.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Run the upload workers (see Video Job Queue) for the life of the server."""
+    app.state.video_workers = [asyncio.create_task(video_worker())
+                               for _ in range(MAX_CONCURRENT_JOBS)]
+    yield
+    for worker in app.state.video_workers:
+        worker.cancel()
+    await asyncio.gather(*app.state.video_workers, return_exceptions=True)
+
+
+app = FastAPI(title="PoseGuard AI", version="2.0.0", default_response_class=ORJSONResponse,
+              lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -44,21 +65,219 @@ app.add_middleware(
 
 UPLOAD_DIR = "uploads"
 OUTPUT_DIR = "outputs"
+ARRAYS_DIR = "analysis_arrays"  # private: not mounted below
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
+os.makedirs(ARRAYS_DIR, exist_ok=True)
 
-# Note: annotated videos served via /outputs/{video_id} endpoint below
+# Annotated outputs and original uploads are served as static files
+# (Range requests for <video> scrubbing, ETag/Last-Modified for caching)
+app.mount("/outputs", StaticFiles(directory=OUTPUT_DIR), name="outputs")
+app.mount("/video", StaticFiles(directory=UPLOAD_DIR), name="video")
 
 # ── YOLO Model (loaded once) ────────────────────────────────────
 
 CONF_THRESH = 0.5
 MODEL_SIZE = "n"
+DEVICE = 0 if torch.cuda.is_available() else "cpu"
+HALF = DEVICE != "cpu"       # fp16 only pays off on GPU tensor cores
+BATCH = 16 if HALF else 4    # frames per forward pass when processing uploads
+IMGSZ = 480                  # inference size; whole-body poses hold up well below 640
+torch.backends.cudnn.benchmark = True  # upload frames share one shape, tune kernels once
 model = YOLO(f"yolov8{MODEL_SIZE}-pose.pt")
+model.fuse()
+# The Ultralytics predictor is not thread-safe and upload batches and live
+# camera frames share one GPU; every inference holds this lock
+model_lock = threading.Lock()
 print(f"✅ YOLOv8{MODEL_SIZE.upper()}-Pose model loaded")
 
+# ── H.264 Output Encoder (probed once) ──────────────────────────
+
+# Hardware encoders first; libx264 is the software fallback. Outputs are
+# throwaway browser previews, so it trades ~30% larger files for speed.
+H264_CANDIDATES = (
+    ("h264_nvenc", ["-preset", "p4"]),
+    ("h264_videotoolbox", []),
+    ("h264_qsv", []),
+    ("libx264", ["-preset", "ultrafast", "-tune", "zerolatency", "-crf", "28", "-threads", "0"]),
+)
+
+
+def probe_h264_encoder():
+    """First H.264 encoder this host's ffmpeg can actually open, as (codec, options)."""
+    for codec, opts in H264_CANDIDATES:
+        try:
+            # Listed in `ffmpeg -encoders` is not enough: nvenc/qsv need the hardware too
+            subprocess.run(
+                ["ffmpeg", "-v", "error", "-f", "lavfi", "-i", "color=s=256x256:d=0.1",
+                 "-c:v", codec, *opts, "-pix_fmt", "yuv420p", "-f", "null", "-"],
+                check=True, capture_output=True, timeout=30,
+            )
+        except FileNotFoundError:
+            return None
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            continue
+        return codec, opts
+    return None
+
+
+H264_ENCODER = probe_h264_encoder()
+if H264_ENCODER:
+    print(f"✅ Encoding annotated videos with {H264_ENCODER[0]}")
+else:
+    print("⚠️ No usable ffmpeg H.264 encoder — using mp4v, install ffmpeg for best browser compatibility")
+
+
+class VideoSink:
+    """Annotated-video writer: pipes raw BGR frames into ffmpeg, or OpenCV mp4v without it.
+
+    If ffmpeg dies within the first REPLAY_FRAMES frames (typically the encoder
+    refusing to open) everything goes to mp4v instead; a later failure raises,
+    as a video missing its start would no longer line up with event frames.
+    Use as a context manager so the encoder is shut down when processing fails.
+    """
+
+    REPLAY_FRAMES = 8  # first frames kept to replay into mp4v if ffmpeg fails to open the encoder
+
+    def __init__(self, path: str, width: int, height: int, fps: float):
+        self.path, self.size, self.fps = path, (width, height), fps
+        self.proc = self.out = None
+        self.head: list = []
+        self.sent = 0
+        if H264_ENCODER:
+            codec, opts = H264_ENCODER
+            self.proc = subprocess.Popen(
+                ["ffmpeg", "-y", "-v", "error",
+                 "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-r", f"{fps}",
+                 "-i", "-",
+                 "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",  # yuv420p encoders reject odd sizes
+                 "-c:v", codec, *opts,
+                 "-pix_fmt", "yuv420p",      # Ensure compatibility with all browsers
+                 "-movflags", "+faststart",  # Enable streaming / progressive playback
+                 "-an", path],
+                stdin=subprocess.PIPE, stderr=subprocess.PIPE,
+            )
+        else:
+            self._open_mp4v()
+
+    def _open_mp4v(self):
+        self.out = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*"mp4v"), self.fps, self.size)
+
+    def _stop_ffmpeg(self) -> tuple[int, str]:
+        """Close ffmpeg's stdin and wait for it; returns (exit code, tail of stderr)."""
+        proc, self.proc = self.proc, None
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+        err = proc.stderr.read().decode(errors="replace")[-500:]
+        return proc.wait(), err
+
+    def _fall_back(self, err: str):
+        if self.sent != len(self.head):
+            raise RuntimeError(f"ffmpeg encode failed after {self.sent} frames: {err}")
+        print(f"⚠️ ffmpeg encode failed, continuing with mp4v: {err.strip()}")
+        self._open_mp4v()
+        for frame in self.head:
+            self.out.write(frame)
+        self.head = []
+
+    def write(self, frame: np.ndarray):
+        if self.proc:
+            try:
+                self.proc.stdin.write(np.ascontiguousarray(frame).data)
+            except OSError:  # ffmpeg exited, e.g. the encoder refused to open
+                self._fall_back(self._stop_ffmpeg()[1])
+            else:
+                self.sent += 1
+                if len(self.head) < self.REPLAY_FRAMES:
+                    self.head.append(frame)
+                return
+        self.out.write(frame)
+
+    def close(self):
+        if self.proc:
+            code, err = self._stop_ffmpeg()
+            if code != 0:
+                self._fall_back(err)  # a short clip can end before the failure shows up
+        self.head = []
+        if self.out:
+            self.out.release()
+            self.out = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        elif self.proc:  # processing failed: stop the encoder without masking the error
+            self.proc.kill()
+            self._stop_ffmpeg()
+        elif self.out:
+            self.out.release()
+
+
 # ── In-memory analysis store ────────────────────────────────────
 
-analyses: dict = {}
+class AnalysisCache(LRUCache):
+    """LRU of analysis summaries that deletes an evicted upload's arrays from disk."""
+
+    def popitem(self):
+        video_id, data = super().popitem()
+        drop_arrays(video_id)
+        return video_id, data
+
+
+# Finished analyses are bounded to the most recent ones; queued and running
+# jobs sit in pending_analyses so a backlog can never evict them. Video workers
+# write these while request handlers read them, and lookups reorder the LRU,
+# so every access takes the lock.
+ANALYSIS_CACHE_SIZE = 128
+analyses: AnalysisCache = AnalysisCache(maxsize=ANALYSIS_CACHE_SIZE)
+pending_analyses: dict = {}
+# video_id → .npz written by process_video; the only files the store ever deletes
+spilled_arrays: dict = {}
+analyses_lock = threading.Lock()
+
+
+def drop_arrays(video_id: str):
+    """Delete the arrays spilled for video_id, if any. Caller holds analyses_lock."""
+    path = spilled_arrays.pop(video_id, None)
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def save_analysis(video_id: str, data: dict, arrays_path: Optional[str] = None):
+    """Store a summary; arrays_path is the .npz holding its pose_keypoints and riskTimeline."""
+    with analyses_lock:
+        if data["status"] == "processing":
+            pending_analyses[video_id] = data
+            return
+        pending_analyses.pop(video_id, None)
+        if spilled_arrays.get(video_id) != arrays_path:
+            drop_arrays(video_id)
+        analyses[video_id] = data
+        if arrays_path:
+            spilled_arrays[video_id] = arrays_path
+
+
+def load_analysis(video_id: str) -> Optional[dict]:
+    with analyses_lock:
+        return pending_analyses.get(video_id) or analyses.get(video_id)
+
+
+def load_arrays_path(video_id: str) -> Optional[str]:
+    with analyses_lock:
+        return spilled_arrays.get(video_id)
+
+
+def analysis_arrays_path(video_id: str) -> str:
+    """Where process_video spills an upload's arrays; video_id is server-generated."""
+    return os.path.join(ARRAYS_DIR, f"{video_id}.npz")
 
 # ── Pydantic Models ──────────────────────────────────────────────
 
@@ -111,140 +330,150 @@ FACTOR_DESCRIPTIONS = {
 
 def calculate_angle(a, b, c):
     """Angle at joint B, formed by A-B-C (in degrees)."""
-    a, b, c = np.array(a, float), np.array(b, float), np.array(c, float)
-    ba, bc = a - b, c - b
-    norm_ba, norm_bc = np.linalg.norm(ba), np.linalg.norm(bc)
+    bx, by = float(b[0]), float(b[1])
+    bax, bay = float(a[0]) - bx, float(a[1]) - by
+    bcx, bcy = float(c[0]) - bx, float(c[1]) - by
+    norm_ba, norm_bc = math.hypot(bax, bay), math.hypot(bcx, bcy)
     if norm_ba == 0 or norm_bc == 0:
         return 180.0
-    cosine = np.dot(ba, bc) / (norm_ba * norm_bc)
-    return float(np.degrees(np.arccos(np.clip(cosine, -1.0, 1.0))))
-
-
-def trunk_lean_angle(shoulder_mid, hip_mid):
-    """Angle of the torso line from vertical."""
-    dx = hip_mid[0] - shoulder_mid[0]
-    dy = hip_mid[1] - shoulder_mid[1]
-    if dy == 0:
-        return 0.0
-    return abs(math.degrees(math.atan2(dx, dy)))
-
-
-def is_visible(kp):
-    return kp[0] > 0 and kp[1] > 0
+    cosine = (bax * bcx + bay * bcy) / (norm_ba * norm_bc)
+    return math.degrees(math.acos(min(max(cosine, -1.0), 1.0)))
+
+
+# Knee/hip factors: (A, B, C) keypoint triplets, angle measured at B.
+# Risk is TRIPLET_LEVELS[i][k] where k counts the thresholds <= angle.
+TRIPLETS = np.array([[11, 13, 15], [12, 14, 16], [5, 11, 13], [6, 12, 14]])
+TRIPLET_DETAILS = ("L_Knee", "R_Knee", "L_Hip", "R_Hip")
+TRIPLET_THRESHOLDS = np.array([[120, 140, 160], [120, 140, 160],
+                               [100, 130, 150], [100, 130, 150]])
+TRIPLET_LEVELS = np.array([[90, 60, 30, 0], [90, 60, 30, 0],
+                           [80, 45, 20, 0], [80, 45, 20, 0]])
+
+# Trunk lean and asymmetry grow riskier as they grow, so they are
+# binned on the negated value against negated thresholds
+TRUNK_THRESHOLDS = np.array([-35, -25, -15])
+TRUNK_LEVELS = np.array([75, 50, 25, 0])
+ASYM_PAIRS = np.array([[5, 6], [11, 12]])
+ASYM_THRESHOLDS = np.array([-40, -25, -15])
+ASYM_LEVELS = np.array([70, 40, 20, 0])
+
+# Ankle dorsiflexion against a virtual toe; also binned on the negated angle
+ANKLE_THRESHOLDS = np.array([-120, -110])
+ANKLE_LEVELS = np.array([60, 30, 0])
+
+# Composite weights, in the order factors are reported
+FACTORS = ("L_ACL", "R_ACL", "L_Hip", "R_Hip", "Trunk",
+           "Shoulder_Asym", "Hip_Asym", "L_Ankle", "R_Ankle")
+FACTOR_WEIGHTS = np.array([0.25, 0.25, 0.10, 0.10, 0.12, 0.05, 0.05, 0.04, 0.04])
+
+# Every factor's ladder as one row, looked up with searchsorted by both
+# scorers. The ankle rows get an unreachable third threshold so all rows
+# share a shape.
+FACTOR_THRESHOLDS = np.vstack([
+    TRIPLET_THRESHOLDS, TRUNK_THRESHOLDS, ASYM_THRESHOLDS, ASYM_THRESHOLDS,
+    [*ANKLE_THRESHOLDS, np.inf], [*ANKLE_THRESHOLDS, np.inf],
+]).astype(float)
+FACTOR_LEVELS = np.vstack([
+    TRIPLET_LEVELS, TRUNK_LEVELS, ASYM_LEVELS, ASYM_LEVELS,
+    [*ANKLE_LEVELS, 0], [*ANKLE_LEVELS, 0],
+]).astype(np.int64)
+
+
+def joint_angles(kps, triplets):
+    """Angles at B for every person and A-B-C triplet: (P,17,2) → (P,T) degrees."""
+    a, b, c = kps[:, triplets[:, 0]], kps[:, triplets[:, 1]], kps[:, triplets[:, 2]]
+    ba, bc = a - b, c - b
+    norms = np.sqrt(np.einsum("pij,pij->pi", ba, ba)) * np.sqrt(np.einsum("pij,pij->pi", bc, bc))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cosine = np.einsum("pij,pij->pi", ba, bc) / norms
+    angles = np.degrees(np.arccos(np.clip(cosine, -1.0, 1.0)))
+    return np.where(norms == 0, 180.0, angles)
 
 
-def analyze_person(person_kp, person_conf):
+def score_people_numpy(kps, confs):
     """
-    Analyze one detected person's pose.
-    Returns (risks dict, composite score 0-100, details dict with angles).
+    Score every person in a frame with NumPy batch math.
+    Returns (P,9) risks in FACTORS order (-1 = not visible), (P,5) knee/hip
+    angles and trunk lean (NaN = not visible), and (P,) composite scores.
     """
-    risks = {}
-    details = {}
-
-    def kp(idx):
-        return person_kp[idx] if (person_conf[idx] > CONF_THRESH and is_visible(person_kp[idx])) else None
-
-    l_shoulder = kp(5);  r_shoulder = kp(6)
-    l_hip      = kp(11); r_hip      = kp(12)
-    l_knee     = kp(13); r_knee     = kp(14)
-    l_ankle    = kp(15); r_ankle    = kp(16)
-
-    # 1. Left Knee ACL
-    if all(v is not None for v in [l_hip, l_knee, l_ankle]):
-        angle = calculate_angle(l_hip, l_knee, l_ankle)
-        details["L_Knee"] = angle
-        if angle < 120:   risks["L_ACL"] = 90
-        elif angle < 140: risks["L_ACL"] = 60
-        elif angle < 160: risks["L_ACL"] = 30
-        else:             risks["L_ACL"] = 0
-
-    # 2. Right Knee ACL
-    if all(v is not None for v in [r_hip, r_knee, r_ankle]):
-        angle = calculate_angle(r_hip, r_knee, r_ankle)
-        details["R_Knee"] = angle
-        if angle < 120:   risks["R_ACL"] = 90
-        elif angle < 140: risks["R_ACL"] = 60
-        elif angle < 160: risks["R_ACL"] = 30
-        else:             risks["R_ACL"] = 0
-
-    # 3. Left Hip
-    if all(v is not None for v in [l_shoulder, l_hip, l_knee]):
-        angle = calculate_angle(l_shoulder, l_hip, l_knee)
-        details["L_Hip"] = angle
-        if angle < 100:   risks["L_Hip"] = 80
-        elif angle < 130: risks["L_Hip"] = 45
-        elif angle < 150: risks["L_Hip"] = 20
-        else:             risks["L_Hip"] = 0
-
-    # 4. Right Hip
-    if all(v is not None for v in [r_shoulder, r_hip, r_knee]):
-        angle = calculate_angle(r_shoulder, r_hip, r_knee)
-        details["R_Hip"] = angle
-        if angle < 100:   risks["R_Hip"] = 80
-        elif angle < 130: risks["R_Hip"] = 45
-        elif angle < 150: risks["R_Hip"] = 20
-        else:             risks["R_Hip"] = 0
-
-    # 5. Trunk Lean
-    if all(v is not None for v in [l_shoulder, r_shoulder, l_hip, r_hip]):
-        shoulder_mid = ((l_shoulder[0] + r_shoulder[0]) / 2,
-                        (l_shoulder[1] + r_shoulder[1]) / 2)
-        hip_mid = ((l_hip[0] + r_hip[0]) / 2,
-                   (l_hip[1] + r_hip[1]) / 2)
-        lean = trunk_lean_angle(shoulder_mid, hip_mid)
-        details["Trunk"] = lean
-        if lean > 35:   risks["Trunk"] = 75
-        elif lean > 25: risks["Trunk"] = 50
-        elif lean > 15: risks["Trunk"] = 25
-        else:           risks["Trunk"] = 0
-
-    # 6. Shoulder Asymmetry
-    if all(v is not None for v in [l_shoulder, r_shoulder]):
-        diff = abs(l_shoulder[1] - r_shoulder[1])
-        if diff > 40:   risks["Shoulder_Asym"] = 70
-        elif diff > 25: risks["Shoulder_Asym"] = 40
-        elif diff > 15: risks["Shoulder_Asym"] = 20
-        else:           risks["Shoulder_Asym"] = 0
-
-    # 7. Hip Asymmetry
-    if all(v is not None for v in [l_hip, r_hip]):
-        diff = abs(l_hip[1] - r_hip[1])
-        if diff > 40:   risks["Hip_Asym"] = 70
-        elif diff > 25: risks["Hip_Asym"] = 40
-        elif diff > 15: risks["Hip_Asym"] = 20
-        else:           risks["Hip_Asym"] = 0
-
-    # 8. Left Ankle
-    if all(v is not None for v in [l_knee, l_ankle]):
-        virtual_toe = (l_ankle[0] + (l_ankle[0] - l_knee[0]) * 0.3, l_ankle[1] + 30)
-        angle = calculate_angle(l_knee, l_ankle, virtual_toe)
-        if angle > 120:   risks["L_Ankle"] = 60
-        elif angle > 110: risks["L_Ankle"] = 30
-        else:             risks["L_Ankle"] = 0
-
-    # 9. Right Ankle
-    if all(v is not None for v in [r_knee, r_ankle]):
-        virtual_toe = (r_ankle[0] + (r_ankle[0] - r_knee[0]) * 0.3, r_ankle[1] + 30)
-        angle = calculate_angle(r_knee, r_ankle, virtual_toe)
-        if angle > 120:   risks["R_Ankle"] = 60
-        elif angle > 110: risks["R_Ankle"] = 30
-        else:             risks["R_Ankle"] = 0
-
-    # Composite weighted score
-    weights = {
-        "L_ACL": 0.25, "R_ACL": 0.25,
-        "L_Hip": 0.10, "R_Hip": 0.10,
-        "Trunk": 0.12,
-        "Shoulder_Asym": 0.05, "Hip_Asym": 0.05,
-        "L_Ankle": 0.04, "R_Ankle": 0.04,
-    }
-    total_weight = sum(weights[k] for k in risks if k in weights)
-    if total_weight > 0:
-        composite = sum(risks[k] * weights[k] for k in risks if k in weights) / total_weight
-    else:
-        composite = 0
-
-    return risks, min(int(composite), 100), details
+    n = len(kps)
+    visible = (confs > CONF_THRESH) & (kps[..., 0] > 0) & (kps[..., 1] > 0)
+    # What each factor's thresholds are compared against, and whether it is visible
+    measure = np.full((n, len(FACTORS)), np.nan)
+    seen = np.zeros((n, len(FACTORS)), bool)
+
+    # 1-4. Knee ACL and hip flexion
+    seen[:, :4] = visible[:, TRIPLETS].all(-1)
+    measure[:, :4] = joint_angles(kps.astype(np.float64), TRIPLETS)
+
+    # 5. Trunk lean from vertical
+    seen[:, 4] = visible[:, [5, 6, 11, 12]].all(-1)
+    shoulder_mid = (kps[:, 5] + kps[:, 6]) / 2
+    hip_mid = (kps[:, 11] + kps[:, 12]) / 2
+    dx, dy = (hip_mid - shoulder_mid).T.astype(np.float64)
+    measure[:, 4] = -np.where(dy == 0, 0.0, np.abs(np.degrees(np.arctan2(dx, dy))))
+
+    # 6-7. Shoulder and hip height asymmetry
+    seen[:, 5:7] = visible[:, ASYM_PAIRS].all(-1)
+    measure[:, 5:7] = -np.abs(kps[:, ASYM_PAIRS[:, 0], 1] - kps[:, ASYM_PAIRS[:, 1], 1])
+
+    # 8-9. Ankles, against a virtual toe projected past each ankle
+    for j, (knee, ankle) in ((7, (13, 15)), (8, (14, 16))):
+        seen[:, j] = visible[:, knee] & visible[:, ankle]
+        for p in np.flatnonzero(seen[:, j]):
+            k, a = kps[p, knee], kps[p, ankle]
+            virtual_toe = (a[0] + (a[0] - k[0]) * 0.3, a[1] + 30)
+            measure[p, j] = -calculate_angle(k, a, virtual_toe)
+
+    # One table lookup per factor in place of the if/elif threshold ladders
+    risk = np.full((n, len(FACTORS)), -1)
+    for j in range(len(FACTORS)):
+        levels = FACTOR_LEVELS[j][np.searchsorted(FACTOR_THRESHOLDS[j], measure[:, j], side="right")]
+        risk[:, j] = np.where(seen[:, j], levels, -1)
+    detail = np.where(seen[:, :5], np.abs(measure[:, :5]), np.nan)
+
+    # Composite weighted score over the factors each person has
+    w = np.where(risk >= 0, FACTOR_WEIGHTS, 0.0)
+    acc = np.zeros(n)
+    total_weight = np.zeros(n)
+    for j in range(len(FACTORS)):  # factor order, as the scalar sum ran
+        acc += np.maximum(risk[:, j], 0) * w[:, j]
+        total_weight += w[:, j]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        composite = np.where(total_weight > 0, acc / total_weight, 0)
+    return risk, detail, np.minimum(composite.astype(int), 100)
+
+
+def score_people(kps, confs):
+    """(risks, details, composites) arrays for every person in a frame, as score_people_numpy."""
+    if DEVICE != "cpu":
+        return score_people_numpy(kps, confs)
+    # No GPU: the biomechanics are a real share of the frame, use the compiled scorer
+    n = len(kps)
+    risk = np.empty((n, len(FACTORS)), np.int64)
+    detail = np.empty((n, 5))
+    composite = np.empty(n, np.int64)
+    score_people_native(np.ascontiguousarray(kps, np.float32),
+                        np.ascontiguousarray(confs, np.float32), CONF_THRESH,
+                        TRIPLETS, FACTOR_THRESHOLDS, FACTOR_LEVELS, FACTOR_WEIGHTS,
+                        risk, detail, composite)
+    return risk, detail, composite
+
+
+def analyze_people(kps, confs):
+    """
+    Analyze every detected person in a frame at once.
+    Takes (P,17,2) keypoints and (P,17) confidences; returns one
+    (risks dict, composite score 0-100, details dict with angles) per person.
+    """
+    risk, detail, composite = score_people(kps, confs)
+    people = []
+    for p in range(len(kps)):
+        risks = {f: int(v) for f, v in zip(FACTORS, risk[p]) if v >= 0}
+        details = {k: float(v) for k, v in zip(TRIPLET_DETAILS + ("Trunk",), detail[p])
+                   if not np.isnan(v)}
+        people.append((risks, int(composite[p]), details))
+    return people
 
 
 # ── Helpers ──────────────────────────────────────────────────────
@@ -263,6 +492,39 @@ def risk_color_bgr(score: int):
     return (0, 0, 230)
 
 
+# COCO limb pairs drawn on annotated frames, and one BGR color per person
+SKELETON = ((5, 7), (7, 9), (6, 8), (8, 10), (5, 6), (5, 11), (6, 12),
+            (11, 12), (11, 13), (13, 15), (12, 14), (14, 16))
+PERSON_COLORS = ((255, 128, 0), (0, 200, 255), (255, 0, 255),
+                 (0, 255, 128), (255, 255, 0), (128, 0, 255))
+
+
+def draw_skeletons(img, kps, confs, radius=3, thickness=1):
+    """Draw each person's limbs and joints onto img in place."""
+    pts = kps.astype(np.int32).tolist()
+    vis = ((confs > CONF_THRESH) & (kps[..., 0] > 0) & (kps[..., 1] > 0)).tolist()
+    for p, (person, seen) in enumerate(zip(pts, vis)):
+        color = PERSON_COLORS[p % len(PERSON_COLORS)]
+        for i, j in SKELETON:
+            if seen[i] and seen[j]:
+                cv2.line(img, person[i], person[j], color, thickness, cv2.LINE_AA)
+        for pt, ok in zip(person, seen):
+            if ok:
+                cv2.circle(img, pt, radius, color, -1, cv2.LINE_AA)
+
+
+# HUD backdrop: the pixels of the filled rectangle (10,10)-(280,65), shaded
+# 60% toward (20,20,20). Only this patch is blended, not a copy of the frame.
+HUD_BOX = (slice(10, 66), slice(10, 281))
+HUD_SHADE = np.full((56, 271, 3), 20, np.uint8)
+
+
+def shade_hud(img):
+    """Darken the HUD box of img in place."""
+    roi = img[HUD_BOX]
+    roi[:] = cv2.addWeighted(HUD_SHADE[:roi.shape[0], :roi.shape[1]], 0.6, roi, 0.4, 0)
+
+
 def frames_to_timestamp(frame: int, fps: float) -> str:
     seconds = frame / fps
     mins = int(seconds // 60)
@@ -270,6 +532,32 @@ def frames_to_timestamp(frame: int, fps: float) -> str:
     return f"{mins}:{secs:02d}"
 
 
+def factor_report(j: int, risk: int, angle: float) -> dict:
+    """Fields shared by snapshot factors and risk events for FACTORS[j]; NaN angle → None."""
+    factor = FACTORS[j]
+    return {
+        "risk": int(risk),
+        "part": FACTOR_TO_PART[factor],
+        "severity": risk_severity(int(risk)),
+        "description": FACTOR_DESCRIPTIONS[factor],
+        "angle": None if np.isnan(angle) else round(float(angle), 1),
+    }
+
+
+def risk_event(j: int, frame: int, risk: int, angle: float, fps: float) -> dict:
+    return {"timestamp": frames_to_timestamp(frame, fps), "frame": int(frame),
+            **factor_report(j, risk, angle)}
+
+
+def keypoints_to_json(samples: np.ndarray) -> list[list[dict]]:
+    """(N,17,3) sampled keypoints → per-keypoint dicts with x, y, confidence and name."""
+    return [
+        [{"x": round(x, 4), "y": round(y, 4), "confidence": round(c, 3), "name": name}
+         for name, (x, y, c) in zip(KEYPOINT_NAMES, person)]
+        for person in samples.tolist()
+    ]
+
+
 def generate_suggestions(events: list, avg_risk: float) -> list[str]:
     suggestions = []
     parts_at_risk = {e["part"] for e in events}
@@ -298,12 +586,152 @@ def generate_suggestions(events: list, avg_risk: float) -> list[str]:
 
 # ── Video Processing Pipeline ────────────────────────────────────
 
+TIMELINE_POINTS = 500  # riskTimeline keeps every k-th frame to stay near this length
+
+def keypoints_to_host(results, pinned=None):
+    """Bring a batch's keypoints to the CPU in one transfer.
+
+    Returns per-result (P,17,2) xy and (P,17) conf arrays, plus the pinned
+    staging tensor to pass back in next time. On GPU this is one non_blocking
+    copy and one stream sync per batch instead of two blocking .cpu() per frame.
+    """
+    data = [r.keypoints.data for r in results if r.keypoints is not None]
+    counts = [0 if r.keypoints is None else len(r.keypoints) for r in results]
+    if not sum(counts):
+        host = np.empty((0, len(KEYPOINT_NAMES), 3), np.float32)
+    elif data[0].is_cuda:
+        stacked = torch.cat(data)
+        if pinned is None or len(pinned) < len(stacked) or pinned.dtype != stacked.dtype:
+            pinned = torch.empty((max(len(stacked), 64), *stacked.shape[1:]),
+                                 dtype=stacked.dtype, pin_memory=True)
+        staged = pinned[:len(stacked)]
+        staged.copy_(stacked, non_blocking=True)
+        torch.cuda.current_stream(stacked.device).synchronize()
+        host = staged.numpy()
+    else:
+        host = torch.cat(data).numpy()
+    per_result = np.split(host, np.cumsum(counts)[:-1])
+    return [k[..., :2] for k in per_result], [k[..., 2] for k in per_result], pinned
+
+
+class FrameReader:
+    """Decodes a video on a background thread into a bounded queue of BGR frames.
+
+    Reads an ffmpeg rawvideo pipe (hardware decode where the host has it),
+    or OpenCV when ffmpeg is not installed. Use as a context manager so an
+    early exit stops the decoder.
+    """
+
+    def __init__(self, path: str, width: int, height: int, maxsize: int = 2 * BATCH):
+        self.path = path
+        self.shape = (height, width, 3)
+        self.queue: queue.Queue = queue.Queue(maxsize)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _decode(self):
+        if shutil.which("ffmpeg"):
+            decoded = 0
+            for frame in self._decode_ffmpeg():
+                decoded += 1
+                yield frame
+            if decoded:
+                return
+            # ffmpeg could not read it (or predates -fps_mode, 5.1); OpenCV yields the same frames
+        yield from self._decode_opencv()
+
+    def _decode_opencv(self):
+        cap = cv2.VideoCapture(self.path)
+        try:
+            while True:
+                ret, frame = cap.read()
+                if not ret:
+                    return
+                yield frame
+        finally:
+            cap.release()
+
+    def _decode_ffmpeg(self):
+        size = self.shape[0] * self.shape[1] * 3
+        proc = subprocess.Popen(
+            ["ffmpeg", "-v", "error", "-hwaccel", "auto", "-i", self.path,
+             # Every decoded frame exactly once, as cap.read() gives them: rawvideo
+             # output otherwise forces constant frame rate, duplicating or
+             # dropping frames of variable-frame-rate (phone) clips
+             "-fps_mode", "passthrough",
+             "-f", "rawvideo", "-pix_fmt", "bgr24", "-"],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=size * 4,
+        )
+        try:
+            while True:
+                frame = np.empty(self.shape, np.uint8)  # writable: the HUD is drawn on it
+                if proc.stdout.readinto(memoryview(frame).cast("B")) < size:
+                    return
+                yield frame
+        finally:
+            proc.kill()
+            proc.wait()
+
+    def _run(self):
+        try:
+            for frame in self._decode():
+                if self.stop.is_set():
+                    break
+                self.queue.put(frame)
+        finally:
+            self.queue.put(None)
+
+    def __iter__(self):
+        while (frame := self.queue.get()) is not None:
+            yield frame
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        while self.thread.is_alive():  # unblock a put() waiting on a full queue
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def batched_keypoints(frames, batch=BATCH):
+    """Yield (frame, keypoints, confs) for every frame, running YOLO on `batch` frames at a time.
+
+    keypoints/confs are views into a staging buffer that the next batch
+    overwrites, so use them before advancing the generator.
+    """
+    pending = []
+    pinned = None
+    for frame in itertools.chain(frames, [None]):
+        if frame is not None:
+            pending.append(frame)
+        if pending and (len(pending) == batch or frame is None):
+            with model_lock:
+                results = model.predict(pending, imgsz=IMGSZ, half=HALF, device=DEVICE, verbose=False)
+                kps, confs, pinned = keypoints_to_host(results, pinned)
+            yield from zip(pending, kps, confs)
+            pending = []
+
+
+def camera_keypoints(frame: np.ndarray):
+    """YOLO on one live camera frame → host (P,17,2) keypoints and (P,17) confs, or (None, None)."""
+    with model_lock:
+        r = model(frame, imgsz=IMGSZ, half=HALF, verbose=False)[0]
+        if r.keypoints is None or r.keypoints.xy is None:
+            return None, None
+        return r.keypoints.xy.cpu().numpy(), r.keypoints.conf.cpu().numpy()
+
+
 def process_video(video_id: str, filepath: str, sport: str = "general"):
     """Run YOLOv8 Pose estimation + biomechanical risk analysis on uploaded video."""
     try:
         cap = cv2.VideoCapture(filepath)
         if not cap.isOpened():
-            analyses[video_id] = {"status": "error", "videoId": video_id, "error": "Could not open video file"}
+            save_analysis(video_id, {"status": "error", "videoId": video_id, "error": "Could not open video file"})
             return
 
         width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
@@ -311,20 +739,26 @@ def process_video(video_id: str, filepath: str, sport: str = "general"):
         fps = cap.get(cv2.CAP_PROP_FPS) or 30
         total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
         duration_secs = total_frames / fps if fps > 0 else 0
+        cap.release()  # only needed for the metadata; FrameReader decodes
 
-        # Annotated output
-        output_raw = os.path.join(OUTPUT_DIR, f"{video_id}_raw.mp4")
-        fourcc = cv2.VideoWriter_fourcc(*"mp4v")
-        out = cv2.VideoWriter(output_raw, fourcc, fps, (width, height))
+        # Annotated output, encoded as frames are produced
+        out = VideoSink(os.path.join(OUTPUT_DIR, f"{video_id}.mp4"), width, height, fps)
 
         frame_count = 0
-        all_risk_scores: list[int] = []
-        all_keypoints: list[list[dict]] = []
+        # Per-frame composite risk (0-100), grown if the header frame count was short
+        risk_scores = np.zeros(max(total_frames, 1), np.uint8)
+        # Sampled keypoints as (sample, keypoint, [x/width, y/height, conf])
+        kp_buf = np.empty((max(total_frames // 10 + 1, 64), len(KEYPOINT_NAMES), 3), np.float32)
+        n_kp_samples = 0
 
-        # Event detection state per risk factor
-        factor_states: dict = {}
+        # Event detection state, one slot per entry of FACTORS
+        active = np.zeros(len(FACTORS), bool)
+        peak_risk = np.zeros(len(FACTORS), int)
+        peak_frame = np.zeros(len(FACTORS), int)
+        peak_angle = np.full(len(FACTORS), np.nan)
 
-        risk_events: list[dict] = []
+        # (factor index, peak frame, peak risk, peak angle); dicts are built after dedup
+        risk_events: list[tuple] = []
 
         # Per-second timestamped analysis snapshots
         timestamped_analysis: list[dict] = []
@@ -334,168 +768,110 @@ def process_video(video_id: str, filepath: str, sport: str = "general"):
 
         print(f"📹 Processing video {video_id}: {width}x{height} @ {fps:.0f}fps, {total_frames} frames")
 
-        while cap.isOpened():
-            ret, frame = cap.read()
-            if not ret:
-                break
-
-            frame_count += 1
-            results = model(frame, verbose=False)
-            annotated = frame.copy()
-            frame_max_risk = 0
-            frame_risks_all: dict = {}
-            frame_details_all: dict = {}
-
-            for r in results:
-                if r.keypoints is None or r.keypoints.xy is None:
-                    continue
-
-                annotated = r.plot(img=annotated, kpt_radius=3, line_width=1)
-                keypoints_np = r.keypoints.xy.cpu().numpy()
-                confs_np = r.keypoints.conf.cpu().numpy()
-
-                for person_idx, (person_kp, person_conf) in enumerate(zip(keypoints_np, confs_np)):
-                    risks, composite, details = analyze_person(person_kp, person_conf)
-                    frame_max_risk = max(frame_max_risk, composite)
-                    frame_risks_all = risks
-                    frame_details_all = details
+        with out, FrameReader(filepath, width, height) as reader:
+            for frame, keypoints_np, confs_np in batched_keypoints(reader):
+                frame_count += 1
+                annotated = frame  # drawn on in place; the clean frame is not needed again
+                frame_max_risk = 0
+                # Per factor: the worst risk of anyone in frame (-1 = nobody
+                # shows it) and that person's angle
+                frame_risk = np.full(len(FACTORS), -1)
+                frame_angle = np.full(len(FACTORS), np.nan)
+
+                if len(keypoints_np):
+                    draw_skeletons(annotated, keypoints_np, confs_np)
+
+                    risk, detail, composite = score_people(keypoints_np, confs_np)
+                    frame_max_risk = int(composite.max())
+                    worst = risk.argmax(axis=0)
+                    frame_risk = risk[worst, np.arange(len(FACTORS))]
+                    frame_angle[:detail.shape[1]] = detail[worst[:detail.shape[1]], np.arange(detail.shape[1])]
 
                     # Sample keypoints every 10 frames (first person only)
-                    if frame_count % 10 == 1 and person_idx == 0:
-                        kp_list = []
-                        for ki in range(min(len(person_kp), len(KEYPOINT_NAMES))):
-                            kp_list.append({
-                                "x": round(float(person_kp[ki][0]) / width, 4),
-                                "y": round(float(person_kp[ki][1]) / height, 4),
-                                "confidence": round(float(person_conf[ki]), 3),
-                                "name": KEYPOINT_NAMES[ki],
-                            })
-                        all_keypoints.append(kp_list)
-
-            all_risk_scores.append(frame_max_risk)
-
-            # ── Per-second snapshot collection ──
-            current_second = int(frame_count / fps) if fps > 0 else 0
-            if current_second != last_snapshot_second:
-                # Save snapshot for the previous second (if we have data)
-                if last_snapshot_second >= 0 and current_second_risks:
-                    # Aggregate: pick highest composite risk frame from this second
-                    best = max(current_second_risks, key=lambda x: x["compositeRisk"])
-                    timestamped_analysis.append(best)
-                # Reset accumulator for new second
-                current_second_risks = []
-                last_snapshot_second = current_second
-
-            # Build snapshot for this frame
-            snapshot_factors = []
-            for factor, risk_val in frame_risks_all.items():
-                if risk_val >= 10:  # include anything non-trivial
-                    detail_key = {
-                        "L_ACL": "L_Knee", "R_ACL": "R_Knee",
-                        "L_Hip": "L_Hip", "R_Hip": "R_Hip", "Trunk": "Trunk",
-                    }.get(factor)
-                    snapshot_factors.append({
-                        "factor": factor,
-                        "risk": risk_val,
-                        "part": FACTOR_TO_PART.get(factor, factor),
-                        "severity": risk_severity(risk_val),
-                        "description": FACTOR_DESCRIPTIONS.get(factor, f"Risk detected in {factor}"),
-                        "angle": round(frame_details_all.get(detail_key, 0), 1) if detail_key and detail_key in frame_details_all else None,
-                    })
-
-            current_second_risks.append({
-                "timestamp": frames_to_timestamp(frame_count, fps),
-                "second": current_second,
-                "frame": frame_count,
-                "compositeRisk": frame_max_risk,
-                "severity": risk_severity(frame_max_risk),
-                "factors": sorted(snapshot_factors, key=lambda x: -x["risk"]),
-            })
-
-            # ── Event detection: track when risk factors activate/deactivate ──
-            for factor, risk_val in frame_risks_all.items():
-                if factor not in factor_states:
-                    factor_states[factor] = {
-                        "active": False, "start_frame": 0,
-                        "peak_risk": 0, "peak_frame": 0, "peak_angle": None,
-                    }
-                state = factor_states[factor]
-                detail_key = {
-                    "L_ACL": "L_Knee", "R_ACL": "R_Knee",
-                    "L_Hip": "L_Hip", "R_Hip": "R_Hip", "Trunk": "Trunk",
-                }.get(factor)
-
-                if risk_val >= 30 and not state["active"]:
-                    state["active"] = True
-                    state["start_frame"] = frame_count
-                    state["peak_risk"] = risk_val
-                    state["peak_frame"] = frame_count
-                    state["peak_angle"] = frame_details_all.get(detail_key)
-                elif risk_val >= 30 and state["active"]:
-                    if risk_val > state["peak_risk"]:
-                        state["peak_risk"] = risk_val
-                        state["peak_frame"] = frame_count
-                        state["peak_angle"] = frame_details_all.get(detail_key)
-                elif risk_val < 30 and state["active"]:
-                    state["active"] = False
-                    risk_events.append({
-                        "timestamp": frames_to_timestamp(state["peak_frame"], fps),
-                        "frame": state["peak_frame"],
-                        "risk": state["peak_risk"],
-                        "part": FACTOR_TO_PART.get(factor, factor),
-                        "severity": risk_severity(state["peak_risk"]),
-                        "description": FACTOR_DESCRIPTIONS.get(factor, f"Risk detected in {factor}"),
-                        "angle": round(state["peak_angle"], 1) if state["peak_angle"] is not None else None,
-                    })
-
-            # ── Draw HUD overlay on annotated frame ──
-            overlay = annotated.copy()
-            cv2.rectangle(overlay, (10, 10), (280, 65), (20, 20, 20), -1)
-            cv2.addWeighted(overlay, 0.6, annotated, 0.4, 0, annotated)
-            color = risk_color_bgr(frame_max_risk)
-            cv2.putText(annotated, f"Risk: {frame_max_risk}% — {risk_severity(frame_max_risk)}",
-                        (18, 42), cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
-            cv2.putText(annotated, f"Frame {frame_count}",
-                        (width - 130, height - 12), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (160, 160, 160), 1)
-
-            out.write(annotated)
-
-            if frame_count % 100 == 0:
-                avg_so_far = np.mean(all_risk_scores)
-                print(f"  Frame {frame_count:5d}/{total_frames}  |  avg risk: {avg_so_far:.1f}%  |  current: {frame_max_risk}%")
+                    if frame_count % 10 == 1:
+                        if n_kp_samples == len(kp_buf):  # frame count in the header was short
+                            kp_buf = np.concatenate([kp_buf, np.empty_like(kp_buf)])
+                        kp_buf[n_kp_samples, :, 0] = keypoints_np[0, :, 0] / width
+                        kp_buf[n_kp_samples, :, 1] = keypoints_np[0, :, 1] / height
+                        kp_buf[n_kp_samples, :, 2] = confs_np[0]
+                        n_kp_samples += 1
+
+                if frame_count > len(risk_scores):
+                    risk_scores = np.concatenate([risk_scores, np.zeros_like(risk_scores)])
+                risk_scores[frame_count - 1] = frame_max_risk
+
+                # ── Per-second snapshot collection ──
+                current_second = int(frame_count / fps) if fps > 0 else 0
+                if current_second != last_snapshot_second:
+                    # Save snapshot for the previous second (if we have data)
+                    if last_snapshot_second >= 0 and current_second_risks:
+                        # Aggregate: pick highest composite risk frame from this second
+                        best = max(current_second_risks, key=lambda x: x["compositeRisk"])
+                        timestamped_analysis.append(best)
+                    # Reset accumulator for new second
+                    current_second_risks = []
+                    last_snapshot_second = current_second
+
+                # Build snapshot for this frame: anything non-trivial
+                snapshot_factors = [{"factor": FACTORS[j], **factor_report(j, frame_risk[j], frame_angle[j])}
+                                    for j in np.flatnonzero(frame_risk >= 10)]
+
+                current_second_risks.append({
+                    "timestamp": frames_to_timestamp(frame_count, fps),
+                    "second": current_second,
+                    "frame": frame_count,
+                    "compositeRisk": frame_max_risk,
+                    "severity": risk_severity(frame_max_risk),
+                    "factors": sorted(snapshot_factors, key=lambda x: -x["risk"]),
+                })
 
-        cap.release()
-        out.release()
+                # ── Event detection: track when risk factors activate/deactivate ──
+                # Factors nobody shows this frame (-1) leave their state alone
+                hot = frame_risk >= 30
+                ended = active & (frame_risk >= 0) & ~hot
+                risk_events.extend((j, peak_frame[j], peak_risk[j], peak_angle[j])
+                                   for j in np.flatnonzero(ended))
+                new_peak = hot & (~active | (frame_risk > peak_risk))
+                peak_risk = np.where(new_peak, frame_risk, peak_risk)
+                peak_frame = np.where(new_peak, frame_count, peak_frame)
+                peak_angle = np.where(new_peak, frame_angle, peak_angle)
+                active = (active | hot) & ~ended
+
+                # ── Draw HUD overlay on annotated frame ──
+                shade_hud(annotated)
+                color = risk_color_bgr(frame_max_risk)
+                cv2.putText(annotated, f"Risk: {frame_max_risk}% — {risk_severity(frame_max_risk)}",
+                            (18, 42), cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
+                cv2.putText(annotated, f"Frame {frame_count}",
+                            (width - 130, height - 12), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (160, 160, 160), 1)
+
+                out.write(annotated)
+
+                if frame_count % 100 == 0:
+                    avg_so_far = risk_scores[:frame_count].mean()
+                    print(f"  Frame {frame_count:5d}/{total_frames}  |  avg risk: {avg_so_far:.1f}%  |  current: {frame_max_risk}%")
 
         # Flush any still-active events
-        for factor, state in factor_states.items():
-            if state["active"] and state["peak_risk"] >= 30:
-                risk_events.append({
-                    "timestamp": frames_to_timestamp(state["peak_frame"], fps),
-                    "frame": state["peak_frame"],
-                    "risk": state["peak_risk"],
-                    "part": FACTOR_TO_PART.get(factor, factor),
-                    "severity": risk_severity(state["peak_risk"]),
-                    "description": FACTOR_DESCRIPTIONS.get(factor, f"Risk detected in {factor}"),
-                    "angle": round(state["peak_angle"], 1) if state["peak_angle"] is not None else None,
-                })
+        risk_events.extend((j, peak_frame[j], peak_risk[j], peak_angle[j])
+                           for j in np.flatnonzero(active & (peak_risk >= 30)))
 
         # Flush last second of timestamped snapshots
         if current_second_risks:
             best = max(current_second_risks, key=lambda x: x["compositeRisk"])
             timestamped_analysis.append(best)
 
-        # Deduplicate events by (timestamp, part), keep highest risk
+        # Deduplicate events by (whole second, part), keep highest risk;
+        # only the survivors get formatted timestamps
         seen: set = set()
         unique_events: list[dict] = []
-        for e in sorted(risk_events, key=lambda x: -x["risk"]):
-            key = (e["timestamp"], e["part"])
+        for j, frame, risk, angle in sorted(risk_events, key=lambda e: -e[2]):
+            key = (int(frame / fps), FACTOR_TO_PART[FACTORS[j]])
             if key not in seen:
                 seen.add(key)
-                unique_events.append(e)
+                unique_events.append(risk_event(j, frame, risk, angle, fps))
 
         # Stats
-        scores_arr = np.array(all_risk_scores) if all_risk_scores else np.array([0])
+        scores_arr = risk_scores[:frame_count] if frame_count else np.array([0])
         overall_risk = int(scores_arr.mean())
         peak_risk = int(scores_arr.max())
         overall_severity = risk_severity(overall_risk)
@@ -506,35 +882,15 @@ def process_video(video_id: str, filepath: str, sport: str = "general"):
 
         suggestions = generate_suggestions(unique_events, float(scores_arr.mean()))
 
-        # Re-encode to H.264 for browser playback
-        h264_path = os.path.join(OUTPUT_DIR, f"{video_id}.mp4")
-        import subprocess
-        try:
-            subprocess.run(
-                ["ffmpeg", "-y", "-i", output_raw,
-                 "-vcodec", "libx264", "-crf", "23", "-preset", "fast",
-                 "-pix_fmt", "yuv420p",  # Ensure compatibility with all browsers
-                 "-movflags", "+faststart",  # Enable streaming / progressive playback
-                 "-an", h264_path],
-                check=True, capture_output=True, timeout=600
-            )
-            ffmpeg_ok = os.path.exists(h264_path) and os.path.getsize(h264_path) > 0
-        except Exception as e:
-            print(f"⚠️ ffmpeg re-encode failed: {e}")
-            ffmpeg_ok = False
-
-        if ffmpeg_ok:
-            os.remove(output_raw)
-        else:
-            # Fallback: rename raw file (mp4v — may not play in all browsers)
-            print("⚠️ Using mp4v fallback — install ffmpeg for best browser compatibility")
-            if os.path.exists(output_raw):
-                os.rename(output_raw, h264_path)
         video_url = f"/outputs/{video_id}.mp4"
 
         print(f"✅ Video {video_id} processed: {frame_count} frames, overall risk {overall_risk}%, {len(unique_events)} events")
 
-        analyses[video_id] = {
+        arrays_path = analysis_arrays_path(video_id)
+        np.savez(arrays_path, keypoints=kp_buf[:n_kp_samples],
+                 timeline=scores_arr[::max(1, len(scores_arr) // TIMELINE_POINTS)])
+
+        save_analysis(video_id, {
             "status": "done",
             "videoId": video_id,
             "sport": sport,
@@ -544,19 +900,36 @@ def process_video(video_id: str, filepath: str, sport: str = "general"):
             "duration": duration_str,
             "fps": int(fps),
             "risks": unique_events[:20],
-            "pose_keypoints": all_keypoints,
             "suggestions": suggestions,
-            "riskTimeline": [int(s) for s in all_risk_scores],
             "timestampedAnalysis": timestamped_analysis,
             "annotatedVideoUrl": video_url,
             "totalFrames": frame_count,
             "peakRisk": peak_risk,
-        }
+        }, arrays_path=arrays_path)
 
     except Exception as e:
         import traceback
         traceback.print_exc()
-        analyses[video_id] = {"status": "error", "videoId": video_id, "error": str(e)}
+        save_analysis(video_id, {"status": "error", "videoId": video_id, "error": str(e)})
+
+
+# ── Video Job Queue ──────────────────────────────────────────────
+
+# Uploads run one at a time per worker so jobs never contend for the GPU;
+# raise on multi-GPU hosts
+MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", "1"))
+job_queue: asyncio.Queue = asyncio.Queue()
+
+
+async def video_worker():
+    """Take queued uploads in order and run process_video off the event loop."""
+    loop = asyncio.get_running_loop()
+    while True:
+        args = await job_queue.get()
+        try:
+            await loop.run_in_executor(None, process_video, *args)
+        finally:
+            job_queue.task_done()
 
 
 # ── Endpoints ────────────────────────────────────────────────────
@@ -567,7 +940,7 @@ def root():
 
 
 @app.post("/upload", response_model=UploadResponse)
-async def upload_video(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+async def upload_video(file: UploadFile = File(...)):
     """Upload a video file and start real YOLO pose analysis in the background."""
     video_id = uuid.uuid4().hex[:8]
     filepath = os.path.join(UPLOAD_DIR, f"{video_id}.mp4")
@@ -575,8 +948,8 @@ async def upload_video(background_tasks: BackgroundTasks, file: UploadFile = Fil
     with open(filepath, "wb") as f:
         shutil.copyfileobj(file.file, f)
 
-    analyses[video_id] = {"status": "processing", "videoId": video_id}
-    background_tasks.add_task(process_video, video_id, filepath)
+    save_analysis(video_id, {"status": "processing", "videoId": video_id})
+    await job_queue.put((video_id, filepath))
 
     return UploadResponse(
         videoId=video_id,
@@ -588,16 +961,28 @@ async def upload_video(background_tasks: BackgroundTasks, file: UploadFile = Fil
 @app.get("/analysis/{video_id}")
 def get_analysis(video_id: str, sport: str = "general"):
     """Return analysis results. Returns status=processing while YOLO is still running."""
-    data = analyses.get(video_id)
+    data = load_analysis(video_id)
     if data is None:
         raise HTTPException(status_code=404, detail="Analysis not found. Upload a video first.")
-    return data
+    if data.get("status") == "done" and "riskTimeline" not in data:
+        # Finished uploads keep their large arrays on disk until requested
+        path = load_arrays_path(video_id)
+        try:
+            if path is None:
+                raise FileNotFoundError(video_id)
+            with np.load(path) as arrays:
+                data = {**data, "pose_keypoints": keypoints_to_json(arrays["keypoints"]),
+                        "riskTimeline": arrays["timeline"]}
+        except FileNotFoundError:  # evicted since the lookup above
+            raise HTTPException(status_code=404, detail="Analysis not found. Upload a video first.")
+    # Returned directly so orjson serializes it without jsonable_encoder's per-value walk
+    return ORJSONResponse(data)
 
 
 @app.post("/chat/{video_id}", response_model=ChatResponse)
 async def chat_with_ai(video_id: str, msg: ChatMessage):
     """Gemini-powered context-aware chat using analysis JSON data."""
-    data = analyses.get(video_id)
+    data = load_analysis(video_id)
     if not data or data.get("status") != "done":
         return ChatResponse(
             reply="⏳ The analysis is still processing. Please wait for it to complete before asking questions.",
@@ -649,7 +1034,6 @@ If asked something outside the scope of this analysis data, politely redirect to
 
     # ── Call Gemini API with retry for rate limits ──
     if gemini_model:
-        import asyncio
         max_retries = 3
         for attempt in range(max_retries):
             try:
@@ -765,7 +1149,8 @@ If asked something outside the scope of this analysis data, politely redirect to
 def get_player(player_id: int):
     """Build player profile from actual analysis history."""
     # Aggregate across all completed analyses
-    completed = [a for a in analyses.values() if a.get("status") == "done"]
+    with analyses_lock:
+        completed = [a for a in analyses.values() if a.get("status") == "done"]
 
     if not completed:
         return {
@@ -858,31 +1243,6 @@ def get_player(player_id: int):
     }
 
 
-@app.get("/outputs/{video_id}.mp4")
-def get_annotated_video(video_id: str):
-    """Serve the annotated/processed video with proper headers."""
-    path = os.path.join(OUTPUT_DIR, f"{video_id}.mp4")
-    if not os.path.exists(path):
-        raise HTTPException(404, "Annotated video not found")
-    return FileResponse(
-        path,
-        media_type="video/mp4",
-        headers={
-            "Accept-Ranges": "bytes",
-            "Cache-Control": "public, max-age=3600",
-        },
-    )
-
-
-@app.get("/video/{video_id}")
-def get_video(video_id: str):
-    """Serve the original uploaded video."""
-    path = os.path.join(UPLOAD_DIR, f"{video_id}.mp4")
-    if not os.path.exists(path):
-        raise HTTPException(404, "Video not found")
-    return FileResponse(path, media_type="video/mp4")
-
-
 # ── Camera Session Store ─────────────────────────────────────────
 camera_sessions: dict = {}
 
@@ -920,7 +1280,7 @@ def save_camera_session(session: CameraSessionSave):
             "factors": [],
         })
 
-    analyses[session.sessionId] = {
+    save_analysis(session.sessionId, {
         "status": "done",
         "videoId": session.sessionId,
         "sport": "general",
@@ -937,7 +1297,7 @@ def save_camera_session(session: CameraSessionSave):
         "annotatedVideoUrl": None,
         "totalFrames": session.totalFrames,
         "peakRisk": peak_risk,
-    }
+    })
     return {"status": "saved", "videoId": session.sessionId}
 
 
@@ -958,6 +1318,7 @@ async def websocket_camera(websocket: WebSocket):
     frame_count = 0
     start_time = time.time()
     fps_times: deque = deque(maxlen=30)
+    loop = asyncio.get_running_loop()
 
     # Per-second tracking for timeline
     per_second_scores: dict[int, list[int]] = {}
@@ -990,23 +1351,17 @@ async def websocket_camera(websocket: WebSocket):
             live_fps = (len(fps_times) / (fps_times[-1] - fps_times[0] + 1e-6)
                         if len(fps_times) > 1 else 0)
 
-            # Run YOLO
-            results = model(frame, verbose=False)
-            annotated = frame.copy()
+            # Run YOLO off the event loop, queued behind any upload batch
+            keypoints_np, confs_np = await loop.run_in_executor(None, camera_keypoints, frame)
+            annotated = frame  # freshly decoded, so drawn on in place
             frame_max_risk = 0
             frame_risks: dict = {}
             frame_details: dict = {}
 
-            for r in results:
-                if r.keypoints is None or r.keypoints.xy is None:
-                    continue
-
-                annotated = r.plot(img=annotated, kpt_radius=4, line_width=2)
-                keypoints_np = r.keypoints.xy.cpu().numpy()
-                confs_np = r.keypoints.conf.cpu().numpy()
+            if keypoints_np is not None:
+                draw_skeletons(annotated, keypoints_np, confs_np, radius=4, thickness=2)
 
-                for person_kp, person_conf in zip(keypoints_np, confs_np):
-                    risks, composite, details = analyze_person(person_kp, person_conf)
+                for risks, composite, details in analyze_people(keypoints_np, confs_np):
                     if composite > frame_max_risk:
                         frame_max_risk = composite
                         frame_risks = risks
@@ -1023,9 +1378,7 @@ async def websocket_camera(websocket: WebSocket):
 
             # Draw HUD on annotated frame
             h, w = annotated.shape[:2]
-            overlay = annotated.copy()
-            cv2.rectangle(overlay, (10, 10), (280, 65), (20, 20, 20), -1)
-            cv2.addWeighted(overlay, 0.6, annotated, 0.4, 0, annotated)
+            shade_hud(annotated)
             color = risk_color_bgr(frame_max_risk)
             cv2.putText(annotated, f"Risk: {frame_max_risk}% - {risk_severity(frame_max_risk)}",
                         (18, 42), cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
@@ -1132,7 +1485,7 @@ async def websocket_camera(websocket: WebSocket):
                     "factors": [],
                 })
 
-            analyses[session_id] = {
+            save_analysis(session_id, {
                 "status": "done",
                 "videoId": session_id,
                 "sport": "general",
@@ -1149,7 +1502,7 @@ async def websocket_camera(websocket: WebSocket):
                 "annotatedVideoUrl": None,
                 "totalFrames": frame_count,
                 "peakRisk": peak_risk,
-            }
+            })
 
         print(f"📷 Camera session {session_id} ended: {frame_count} frames, "
               f"avg risk {int(np.mean(all_scores)) if all_scores else 0}%")
\ No newline at end of file
@@ -153,7 +153,7 @@ export function getAnnotatedVideoUrl(path: string): string {
 }
 
 export function getOriginalVideoUrl(videoId: string): string {
-  return `${API_BASE}/video/${videoId}`;
+  return `${API_BASE}/video/${videoId}.mp4`;
 }
 
 export function getCameraWebSocketUrl(): string {